@@ -1,23 +1,12 @@
 import argparse
 from document_processor import read_queries, write_output
 from prompt_templates import create_RAG_correction_template
-from langchain_openai import ChatOpenAI
-from langchain.schema import HumanMessage
-import configparser
+from config import load_config, set_llm_environment
+from rate_limiter import CircuitOpenError, get_rate_limiter
+from token_counter import BudgetExceededError, count_tokens, get_ledger, write_run_report
+from streaming import ResultStreamWriter, stream_completion
 import os
 
-CUR_DIR = os.path.dirname(os.path.abspath(__file__))
-CONFIG = os.path.join(CUR_DIR, 'config.ini')
-
-def load_config(field: str, value: str) -> str:
-    config = configparser.ConfigParser()
-    config.read(CONFIG)
-    return config[field][value]
-
-
-os.environ["OPENAI_API_BASE"] = load_config('LLM', 'api_base')
-os.environ["OPENAI_API_KEY"] = load_config('LLM', 'api_key')
-
 def read_and_split_queries(file_path):
     print(f"Reading and splitting queries from {file_path}")
     with open(file_path, 'r', encoding='utf-8') as f:
@@ -26,10 +15,53 @@ def read_and_split_queries(file_path):
     print(f"Total {len(queries)} queries found.")
     return queries
 
+def correct_query(query, llm, rag_correction_template, writer=None):
+    from langchain.schema import HumanMessage
+
+    prompt_text = rag_correction_template.format(context="", question=query)
+    print(f"RAG correction prompt: {prompt_text}")
+
+    # The corrected function is about as long as the labelled input
+    tokens = count_tokens(prompt_text) + count_tokens(query)
+    get_ledger().check(tokens)
+    messages = [HumanMessage(content=prompt_text)]
+    if writer is not None:
+        chunks = lambda: (chunk.content for chunk in llm.stream(messages))
+        result = get_rate_limiter().call(
+            lambda: stream_completion(chunks(), query.split("\n"), writer), tokens, hedge=False
+        )
+    else:
+        result = get_rate_limiter().call(
+            lambda: llm.invoke(messages), tokens, prompt_tokens=count_tokens(prompt_text)
+        ).content.strip()
+    get_ledger().charge("correction", count_tokens(prompt_text), count_tokens(result))
+    return result
+
 def process_file(file_path, output_dir, llm, rag_correction_template):
     queries = read_and_split_queries(file_path)
     results = []
 
+    base_filename = os.path.basename(file_path).split('.')[0]
+    output_path = os.path.join(output_dir, f"{base_filename}_RAG_Correct.txt")
+
+    if load_config("LLM", "stream", "false").lower() == "true":
+        # Streaming mode writes corrected lines to the output file as they arrive
+        print(f"Streaming results to {output_path}")
+        with open(output_path, "w", encoding="utf-8") as f:
+            writer = ResultStreamWriter(f)
+            for query_index, query in enumerate(queries):
+                query = query.strip()
+                if not query:
+                    continue
+                get_ledger().set_context(base_filename, f"Query {query_index + 1}")
+                writer.begin(f"Query {query_index + 1}")
+                try:
+                    correct_query(query, llm, rag_correction_template, writer)
+                finally:
+                    writer.end()
+        return
+
+    budget_error = None
     for query_index, query in enumerate(queries):
         query = query.strip()
         if not query:
@@ -37,21 +69,23 @@ def process_file(file_path, output_dir, llm, rag_correction_template):
 
         print(f"Processing query {query_index + 1}: {query}")
 
-        
-        prompt_text = rag_correction_template.format(context="", question=query)
-        print(f"RAG correction prompt: {prompt_text}")
-
-        result = llm.invoke([HumanMessage(content=prompt_text)]).content.strip()
+        get_ledger().set_context(base_filename, f"Query {query_index + 1}")
+        try:
+            result = correct_query(query, llm, rag_correction_template)
+        except (BudgetExceededError, CircuitOpenError) as e:
+            budget_error = e
+            break
         results.append(f"Query {query_index + 1}:\n{result}\n")
 
         print(f"Results for query {query_index + 1} have been processed.")
 
    
-    base_filename = os.path.basename(file_path).split('.')[0]
-    output_path = os.path.join(output_dir, f"{base_filename}_RAG_Correct.txt")
     print(f"Writing results to {output_path}")
     write_output(output_path, "\n/////\n".join(results))
 
+    if budget_error is not None:
+        raise budget_error
+
 def main():
     parser = argparse.ArgumentParser(description="Process text queries with RAG correction.")
     parser.add_argument('--input_dir', type=str, default='correction_input', help="Input directory containing query files.")
@@ -66,17 +100,26 @@ def main():
         os.makedirs(output_dir)
 
 
+    from langchain_openai import ChatOpenAI
+
+    set_llm_environment()
     model_name = load_config("LLM", "model")
     temperature = float(load_config("LLM", "temperature"))
     llm = ChatOpenAI(model=model_name, temperature=temperature)
     rag_correction_template = create_RAG_correction_template()
 
-    for root, dirs, files in os.walk(testdata_dir):
-        for file in files:
-            file_path = os.path.join(root, file)
-            print(f"Processing file: {file_path}")
-            process_file(file_path, output_dir, llm, rag_correction_template)
-
+    try:
+        for root, dirs, files in os.walk(testdata_dir):
+            for file in files:
+                file_path = os.path.join(root, file)
+                print(f"Processing file: {file_path}")
+                process_file(file_path, output_dir, llm, rag_correction_template)
+    except (BudgetExceededError, CircuitOpenError) as e:
+        print(f"Stopping: {e}")
+
+    print(get_rate_limiter().report())
+    print(get_ledger().report())
+    write_run_report(output_dir, {"tokens": get_ledger().to_dict(), "rate_limit": get_rate_limiter().to_dict()})
     print("All files have been processed and results have been written to the output directory.")
 
 if __name__ == "__main__":
@@ -1,7 +1,18 @@
+import os
 import re
+import sys
+import glob
+import argparse
 from collections import defaultdict
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from alignment import split_functions, align_functions, align_lines
+from structured_output import load_records, records_to_text
+
 def read_file(file_path):
+    if file_path.endswith('.jsonl'):
+        # Structured detection output: rebuild the labelled functions from the line records
+        return records_to_text(load_records(file_path))
     with open(file_path, 'r', encoding='utf-8') as file:
         return file.read()
 
@@ -84,6 +95,142 @@ def compare_annotations_by_label(gt_lines, model_lines):
 
     return results, all_labels
 
+def extract_label(line):
+    match = re.search(r'//\s*I\d', line)
+    return match.group(0).replace(" ", "") if match else None
+
+def align_annotations(gt_content, model_content):
+    """Pair every ground-truth line with the label of its aligned model line
+
+    Returns (gt_lines, aligned_model_lines, unaligned_model_lines). gt_lines uses the
+    extract_lines_with_annotations layout; aligned_model_lines holds the model
+    (line_number, code, annotation) for each ground-truth line, or None when the
+    model output has no matching line.
+    """
+    gt_functions = split_functions(gt_content)
+    model_functions = split_functions(model_content)
+
+    gt_lines = []
+    aligned_model_lines = []
+    unaligned_model_lines = []
+    model_line_number = 0
+    function_pairs = dict(align_functions(gt_functions, model_functions))
+    model_offsets = []
+    for lines in model_functions:
+        model_offsets.append(model_line_number)
+        model_line_number += len(lines)
+
+    paired_model_functions = set(function_pairs.values())
+    for model_index, lines in enumerate(model_functions):
+        if model_index not in paired_model_functions:
+            for line_index, line in enumerate(lines):
+                unaligned_model_lines.append((model_offsets[model_index] + line_index + 1, line.strip(), extract_label(line)))
+
+    for gt_index, lines in enumerate(gt_functions):
+        line_pairs = {}
+        model_lines = []
+        model_index = function_pairs.get(gt_index)
+        if model_index is not None:
+            model_lines = model_functions[model_index]
+            line_pairs = dict(align_lines(lines, model_lines))
+            aligned = set(line_pairs.values())
+            for line_index, line in enumerate(model_lines):
+                if line_index not in aligned:
+                    unaligned_model_lines.append((model_offsets[model_index] + line_index + 1, line.strip(), extract_label(line)))
+
+        for line_index, line in enumerate(lines):
+            match = re.search(r'(.*?)(//\s*I\d)', line)
+            code = match.group(1).strip() if match else line.strip()
+            gt_lines.append((len(gt_lines) + 1, code, extract_label(line)))
+
+            model_line_index = line_pairs.get(line_index)
+            if model_line_index is None:
+                aligned_model_lines.append(None)
+            else:
+                model_line = model_lines[model_line_index]
+                aligned_model_lines.append(
+                    (model_offsets[model_index] + model_line_index + 1, model_line.strip(), extract_label(model_line))
+                )
+
+    return gt_lines, aligned_model_lines, unaligned_model_lines
+
+def compare_aligned_annotations(gt_lines, aligned_model_lines, unaligned_model_lines):
+    """Same counting rules as compare_annotations, but line by line on the alignment"""
+    tp = 0
+    fp = 0
+    fn = 0
+
+    fp_lines = []
+    fn_lines = []
+
+    for gt_line, model_line in zip(gt_lines, aligned_model_lines):
+        line_number, code, annotation = gt_line
+        model_annotation = model_line[2] if model_line else None
+        if annotation:
+            if model_annotation == annotation:
+                tp += 1
+            elif model_annotation is None:
+                fn += 1
+                fn_lines.append(gt_line)
+        elif model_annotation:
+            fp += 1
+            fp_lines.append(model_line)
+
+    for model_line in unaligned_model_lines:
+        if model_line[2]:
+            fp += 1
+            fp_lines.append(model_line)
+
+    tn = len(gt_lines) - tp - fn
+
+    return tp, tn, fp, fn, sorted(fp_lines), sorted(fn_lines)
+
+def compare_aligned_annotations_by_label(gt_lines, aligned_model_lines, unaligned_model_lines):
+    results = defaultdict(lambda: {'tp': 0, 'tn': 0, 'fp': 0, 'fn': 0})
+
+    all_labels = ['//I1', '//I2', '//I3', '//I4', '//I5', '//I6']
+
+    for gt_line, model_line in zip(gt_lines, aligned_model_lines):
+        annotation = gt_line[2]
+        model_annotation = model_line[2] if model_line else None
+        if annotation:
+            if model_annotation == annotation:
+                results[annotation]['tp'] += 1
+            elif model_annotation is None:
+                results[annotation]['fn'] += 1
+        elif model_annotation:
+            results[model_annotation]['fp'] += 1
+
+    for model_line in unaligned_model_lines:
+        if model_line[2]:
+            results[model_line[2]]['fp'] += 1
+
+    for label in all_labels:
+        total_lines = len(gt_lines)
+        results[label]['tn'] = total_lines - results[label]['tp'] - results[label]['fn']
+
+    return results, all_labels
+
+def find_file_pairs(ground_truth_path, model_output_path):
+    """Pair files, or the files of two directories by name (curl-GT.txt with curl_RAG_answer.jsonl/.txt or curl.txt)"""
+    if not os.path.isdir(ground_truth_path):
+        return [(ground_truth_path, model_output_path)]
+
+    def stem(file_path):
+        name = os.path.basename(file_path).split('.')[0]
+        return re.sub(r'(-GT|_RAG_answer)$', '', name)
+
+    model_files = {stem(path): path for path in glob.glob(os.path.join(model_output_path, '*.txt'))}
+    # Prefer structured results when both are present
+    model_files.update({stem(path): path for path in glob.glob(os.path.join(model_output_path, '*.jsonl'))})
+    pairs = []
+    for gt_file in sorted(glob.glob(os.path.join(ground_truth_path, '*.txt'))):
+        if stem(gt_file) in model_files:
+            pairs.append((gt_file, model_files[stem(gt_file)]))
+        else:
+            print(f"Warning: No model output for {gt_file}")
+    return pairs
+
 def calculate_metrics(tp, tn, fp, fn):
     accuracy = (tp + tn) / (tp + tn + fp + fn) if (tp + tn + fp + fn) > 0 else 0
     precision = tp / (tp + fp) if (tp + fp) > 0 else 0
@@ -94,16 +241,38 @@ def calculate_metrics(tp, tn, fp, fn):
     return accuracy, precision, recall, f1_score, specificity
 
 def main():
-    ground_truth_file = 'ground_truth.txt'
-    model_output_file = 'model_output.txt'
+    parser = argparse.ArgumentParser(description="Evaluate distortion labels against the ground truth.")
+    parser.add_argument('--ground_truth', type=str, default='ground_truth.txt', help="Ground truth file or directory.")
+    parser.add_argument('--model_output', type=str, default='model_output.txt', help="Model output file or directory.")
+    parser.add_argument('--no_align', action='store_true', help="Compare by code text only, for manually aligned files.")
+    parser.add_argument('--per_label', action='store_true', help="Also print precision and recall for each label I1-I6.")
+    args = parser.parse_args()
 
-    ground_truth_content = read_file(ground_truth_file)
-    model_output_content = read_file(model_output_file)
+    tp = tn = fp = fn = 0
+    label_counts = defaultdict(lambda: {'tp': 0, 'tn': 0, 'fp': 0, 'fn': 0})
+    all_labels = []
+    for ground_truth_file, model_output_file in find_file_pairs(args.ground_truth, args.model_output):
+        ground_truth_content = read_file(ground_truth_file)
+        model_output_content = read_file(model_output_file)
 
-    ground_truth_annotations = extract_lines_with_annotations(ground_truth_content)
-    model_output_annotations = extract_lines_with_annotations(model_output_content)
+        if args.no_align:
+            ground_truth_annotations = extract_lines_with_annotations(ground_truth_content)
+            model_output_annotations = extract_lines_with_annotations(model_output_content)
+
+            counts = compare_annotations(ground_truth_annotations, model_output_annotations)
+            if args.per_label:
+                results, all_labels = compare_annotations_by_label(ground_truth_annotations, model_output_annotations)
+        else:
+            aligned = align_annotations(ground_truth_content, model_output_content)
+            counts = compare_aligned_annotations(*aligned)
+            if args.per_label:
+                results, all_labels = compare_aligned_annotations_by_label(*aligned)
 
-    tp, tn, fp, fn, fp_lines, fn_lines = compare_annotations(ground_truth_annotations, model_output_annotations)
+        tp, tn, fp, fn = tp + counts[0], tn + counts[1], fp + counts[2], fn + counts[3]
+        if args.per_label:
+            for label, label_result in results.items():
+                for key in label_result:
+                    label_counts[label][key] += label_result[key]
 
     overall_accuracy, overall_precision, overall_recall, overall_f1_score, overall_specificity = calculate_metrics(tp, tn, fp, fn)
 
@@ -111,6 +280,15 @@ def main():
     print(f"  Accuracy: {overall_accuracy:.2f}")
     print(f"  Precision: {overall_precision:.2f}")
 
+    if args.per_label:
+        print("Per-Label Metrics:")
+        for label in all_labels:
+            counts = label_counts[label]
+            accuracy, precision, recall, f1_score, specificity = calculate_metrics(
+                counts['tp'], counts['tn'], counts['fp'], counts['fn']
+            )
+            print(f"  {label.lstrip('/')}: Precision {precision:.2f}, Recall {recall:.2f} "
+                  f"(TP {counts['tp']}, FP {counts['fp']}, FN {counts['fn']})")
 
 
 if __name__ == "__main__":
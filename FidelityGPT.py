@@ -1,62 +1,57 @@
 import os
 import sys
-import configparser
+import time
+import argparse
+import threading
+import multiprocessing
 from typing import List
 from document_processor import (
+    BLOCK_OVERLAP,
+    BLOCK_SIZE,
+    FAILED_MARKER,
     load_document,
     split_document,
+    split_into_blocks,
     read_queries,
-    write_output
+    write_output,
+    normalize_code_line,
 )
-from pattern_matcher import match_patterns
+from pattern_matcher import analyze_fidelity_file, calculate_max_semantic_strength, is_relevant_line, select_lines
 from embedding_retriever import (
     create_embedding,
     create_vectorstore,
     create_retriever,
-    retrieve_documents,
+    retrieve_hits_by_query,
 )
+from context_builder import build_context
 from prompt_templates import (
     create_RAG_prompt_template,
-    create_RAG_promptwithvariable_template
+    create_RAG_promptwithvariable_template,
+    create_RAG_compact_prompt_template,
+    create_RAG_compact_promptwithvariable_template,
 )
-from langchain_core.runnables import RunnablePassthrough
-from langchain_core.output_parsers import StrOutputParser
-from langchain_openai import ChatOpenAI
 import variabledependency
-
-# Get current directory and config file path
-CUR_DIR = os.path.dirname(os.path.abspath(__file__))
-CONFIG = os.path.join(CUR_DIR, "config.ini")
-
-
-def load_config(field: str, value: str) -> str:
-    """Load parameters from config file"""
-    config = configparser.ConfigParser()
-    try:
-        config.read(CONFIG, encoding='utf-8')
-        return config[field][value]
-    except KeyError:
-        print(f"Error: Cannot find [{field}] {value} in config file")
-        sys.exit(1)
-    except UnicodeDecodeError:
-        print(f"Error: Config file encoding issue. Please save config.ini as UTF-8")
-        sys.exit(1)
-
-
-# Set OpenAI environment variables
-os.environ["OPENAI_API_BASE"] = load_config("LLM", "api_base")
-os.environ["OPENAI_API_KEY"] = load_config("LLM", "api_key")
-
-
-def format_docs(docs: List[str]) -> str:
-    """Format document list to string"""
-    return "\n\n".join(docs)
+from config import load_config, set_llm_environment
+from rate_limiter import CircuitOpenError, get_rate_limiter
+from token_counter import BudgetExceededError, count_tokens, get_ledger, write_run_report
+from streaming import ResultStreamWriter, stream_completion
+from work_queue import SharedUsage, WorkQueue, worker_name
+from scheduler import ProgressReporter
+from structured_output import JsonlWriter, export_parquet, function_records
+from triage import init_triage
+from prefetch import Prefetcher
+from memory_profile import PROFILER
+from dialect import init_router
+from compact_output import apply_compact_labels, compact_output_enabled, longest_compact_answer, number_lines
+
+RETRIEVE_LOG_LOCK = threading.Lock()
 
 
 def append_to_retrieve_log(file_path: str, sub_query: str, context: str):
     """Append retrieval log to file"""
     try:
-        with open(file_path, "a", encoding="utf-8") as f:
+        # Entries from concurrent threads (server, prefetch) are written whole
+        with RETRIEVE_LOG_LOCK, open(file_path, "a", encoding="utf-8") as f:
             f.write(f"Sub-query:\n{sub_query}\n")
             f.write(f"Formatted context:\n{context}\n")
             f.write("/////\n")
@@ -64,19 +59,339 @@ def append_to_retrieve_log(file_path: str, sub_query: str, context: str):
         pass
 
 
-def split_into_blocks(lines: List[str], block_size: int = 50, overlap: int = 5) -> List[List[str]]:
-    """Split long text into blocks with overlap support"""
-    blocks = []
-    total_lines = len(lines)
-
+def merge_blocks(block_results: List[str], blocks: List[List[str]]) -> str:
+    """Merge labelled block outputs back into one function, dropping overlap lines"""
+    merged = []
+    for block_index, block_result in enumerate(block_results):
+        output_lines = block_result.rstrip().split("\n")
+
+        # The model may append braces to close a chunk, keep only as many trailing braces as the input had
+        extra_braces = count_trailing_braces(output_lines) - count_trailing_braces(blocks[block_index])
+        if extra_braces > 0:
+            output_lines = output_lines[:-extra_braces]
+
+        if block_index > 0:
+            # Skip the leading lines that repeat the overlap with the previous block
+            overlap_lines = [normalize_code_line(line) for line in blocks[block_index][:BLOCK_OVERLAP]]
+            position = 0
+            while position < len(output_lines) and overlap_lines:
+                code = normalize_code_line(output_lines[position])
+                if not code:
+                    position += 1
+                elif code == overlap_lines[0]:
+                    overlap_lines.pop(0)
+                    position += 1
+                else:
+                    break
+            output_lines = output_lines[position:]
+        merged.extend(output_lines)
+    return "\n".join(merged)
+
+
+def count_trailing_braces(lines: List[str]) -> int:
+    """Count the brace-only lines at the end of a block"""
+    count = 0
+    for line in reversed(lines):
+        if normalize_code_line(line) not in ['{', '}']:
+            break
+        count += 1
+    return count
+
+
+def detection_tokens(variables: dict, full_prompt: str, compact=False) -> int:
+    """Estimated tokens of one detection call: the prompt and the longest expected answer"""
+    # The answer repeats the question (or, in compact mode, at most one line: label pair per line)
+    if compact:
+        answer_bound = longest_compact_answer(len(variables["question"].split("\n")))
+    else:
+        answer_bound = variables["question"]
+    return count_tokens(full_prompt) + count_tokens(answer_bound)
+
+
+def invoke_chain(RAG_chain, variables: dict, full_prompt: str, label: str, writer=None, compact=False):
+    """Call the model through the shared rate limiter, returning None once retries are exhausted
+
+    With a writer the completion is streamed and each labelled line is written as soon as it is complete.
+    Raises BudgetExceededError, without calling the model, when the run's token budget would be exceeded,
+    and CircuitOpenError when the endpoint keeps failing.
+    """
+    tokens = detection_tokens(variables, full_prompt, compact)
+    get_ledger().check(tokens)
+    if writer is None:
+        call = lambda: RAG_chain.invoke(variables).strip()
+    else:
+        writer.begin(label)
+        input_lines = variables["question"].split("\n")
+        call = lambda: stream_completion(RAG_chain.stream(variables), input_lines, writer)
+    try:
+        # A streamed call writes into the answer file, so it is never duplicated by hedging
+        RAG_result = get_rate_limiter().call(
+            call, tokens, hedge=writer is None, prompt_tokens=count_tokens(full_prompt)
+        )
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        print(f"Error: {label} failed after retries: {e}")
+        get_ledger().record_failure(label, str(e))
+        if writer is not None:
+            # Keep the failure visible in the streamed answer file, after any lines already written
+            writer.write_lines([FAILED_MARKER], skip=writer.written)
+        return None
+    finally:
+        if writer is not None:
+            writer.end()
+
+    get_ledger().charge("detection", count_tokens(full_prompt), count_tokens(RAG_result))
+    return RAG_result
+
+
+def retrieve_for_blocks(lines: List[str], blocks: List[List[str]], retriever, weights=None):
+    """Pattern-match and retrieve for every block of a function, returning (matched_lines, retrieved_docs) per block
+
+    Lines are scored once per function and retrieved once per distinct line,
+    then sliced into blocks; only the function's first line is skipped as the
+    signature, so overlap lines get the same scores and hits in both blocks.
+    """
+    if weights is None:
+        weights = analyze_fidelity_file(load_config("PATHS", "knowledge_base", "fidelity_new.c"))
+    strengths = [None] + [calculate_max_semantic_strength(line, weights) for line in lines[1:]]
+
+    matched = []
     start = 0
-    while start < total_lines:
-        end = min(start + block_size, total_lines)
-        block = lines[start:end]
-        blocks.append(block)
-        start += block_size - overlap
+    for block in blocks:
+        line_strengths = [
+            (line, *strengths[start + offset])
+            for offset, line in enumerate(block)
+            if start + offset > 0 and is_relevant_line(line)
+        ]
+        matched.append(select_lines(line_strengths))
+        start += BLOCK_SIZE - BLOCK_OVERLAP
+
+    hits = retrieve_hits_by_query(retriever, [line for matched_lines in matched for line in matched_lines])
+    return [
+        (matched_lines, [hit for line in matched_lines if line.strip() for hit in hits[line.strip()]])
+        for matched_lines in matched
+    ]
+
+
+def prepare_blocks(
+        query_index: int,
+        query: str,
+        retriever,
+        RAG_prompt,
+        RAG_prompt_with_variable,
+        weights=None,
+        router=None,
+):
+    """Run the stages before the detection call for one function, yielding one prepared block at a time
+
+    Covers variable analysis, pattern matching, retrieval and prompt building.
+    A prepared block is a dict with block_index (None when the function is
+    processed in one piece), label, prompt, variables, full_prompt and
+    retrieved_docs; variables is None when a stage failed. With a
+    DialectRouter, the knowledge base of the function's decompiler is used.
+    """
+    if router is not None:
+        dialect, retriever, weights = router.select(query)
+    # In compact mode the model sees numbered lines and answers with line: label pairs
+    compact = compact_output_enabled()
+    sub_queries = query.strip().split("\n")
+    query_line_count = len(sub_queries)
+
+    # Decide processing method based on query line count
+    if query_line_count > 50:
+        # More than 50 lines, perform variable name extraction and block processing
+        # Close to the token budget the LLM variable modes fall back to the local analysis
+        try:
+            variable_names = variabledependency.redundant_variable_names(
+                "\n".join(sub_queries), allow_llm=not get_ledger().degraded()
+            )
+        except Exception:
+            variable_names = ""
+
+        # Process queries in blocks
+        blocks = split_into_blocks(sub_queries)
+
+        # Pattern matching and retrieval, once per function
+        try:
+            block_retrievals = retrieve_for_blocks(sub_queries, blocks, retriever, weights)
+        except Exception:
+            block_retrievals = [None] * len(blocks)
+
+        for block_index, block in enumerate(blocks):
+            label = f"Query {query_index + 1}, Block {block_index + 1}"
+            if block_retrievals[block_index] is None:
+                yield {"block_index": block_index, "label": label, "variables": None}
+                continue
+            matched_lines, retrieved_docs = block_retrievals[block_index]
+
+            # Drop near-duplicate hits and repeated explanations, within the context token cap
+            context = build_context(retrieved_docs)
+
+            # Log retrieval
+            append_to_retrieve_log("retrieve-new.txt", "\n".join(block), context)
+
+            # Build variables dictionary
+            variables = {
+                "Variable_names": variable_names,
+                "context": context,
+                "question": number_lines(block) if compact else "\n".join(block),
+            }
+
+            # Generate complete prompt
+            full_prompt = RAG_prompt_with_variable.format(**variables)
+            print(f"\n[Prompt for {label}]:\n{full_prompt}\n")
+
+            yield {
+                "block_index": block_index,
+                "label": label,
+                "prompt": RAG_prompt_with_variable,
+                "variables": variables,
+                "full_prompt": full_prompt,
+                "retrieved_docs": retrieved_docs,
+                "lines": block,
+                "compact": compact,
+            }
+    else:
+        # Less than or equal to 50 lines, process directly
+        label = f"Query {query_index + 1}"
+        # Pattern matching and retrieval
+        try:
+            matched_lines, retrieved_docs = retrieve_for_blocks(sub_queries, [sub_queries], retriever, weights)[0]
+        except Exception:
+            yield {"block_index": None, "label": label, "variables": None}
+            return
+
+        # Drop near-duplicate hits and repeated explanations, within the context token cap
+        context = build_context(retrieved_docs)
+
+        # Log retrieval
+        append_to_retrieve_log("retrieve-new.txt", "\n".join(matched_lines), context)
+
+        # Build variables dictionary
+        variables = {
+            "context": context,
+            "question": number_lines(sub_queries) if compact else query,
+        }
+
+        # Generate complete prompt
+        full_prompt = RAG_prompt.format(**variables)
+        print(f"\n[Prompt for {label}]:\n{full_prompt}\n")
+
+        yield {
+            "block_index": None,
+            "label": label,
+            "prompt": RAG_prompt,
+            "variables": variables,
+            "full_prompt": full_prompt,
+            "retrieved_docs": retrieved_docs,
+            "lines": sub_queries,
+            "compact": compact,
+        }
+
+
+def run_block(block: dict, llm, writer=None, trace=None):
+    """Detection call for one prepared block, returning (block_index, result)"""
+    from langchain_core.runnables import RunnablePassthrough
+    from langchain_core.output_parsers import StrOutputParser
+
+    if block["variables"] is None:
+        get_ledger().record_failure(block["label"], "preparation failed")
+        if writer is not None:
+            writer.begin(block["label"])
+            writer.write_lines([FAILED_MARKER])
+            writer.end()
+        return block["block_index"], None
+
+    # Build RAG chain
+    RAG_chain = (
+            {name: RunnablePassthrough() for name in block["variables"]}
+            | block["prompt"]
+            | llm
+            | StrOutputParser()
+    )
+
+    # Call model to generate result
+    started = time.perf_counter()
+    if block["compact"]:
+        # The short answer is not streamed; the labelled lines are rebuilt and written once it is complete
+        RAG_result = invoke_chain(RAG_chain, block["variables"], block["full_prompt"], block["label"], compact=True)
+        if RAG_result is not None:
+            RAG_result = apply_compact_labels(block["lines"], RAG_result)
+            if writer is not None:
+                writer.begin(block["label"])
+                writer.write_lines(RAG_result.split("\n"))
+                writer.end()
+    else:
+        RAG_result = invoke_chain(RAG_chain, block["variables"], block["full_prompt"], block["label"], writer)
+    if trace is not None:
+        trace[block["block_index"]] = provenance(block["retrieved_docs"], started)
+    return block["block_index"], RAG_result
+
+
+def detect_query(
+        query_index: int,
+        query: str,
+        retriever,
+        llm,
+        RAG_prompt,
+        RAG_prompt_with_variable,
+        weights=None,
+        writer=None,
+        trace=None,
+        router=None,
+):
+    """Run detection for a single function
+
+    Returns a list of (block_index, result) pairs. block_index is None when the
+    function was processed in one piece, and result is None when a stage failed.
+    Pass a ResultStreamWriter to stream each result into the answer file, and a
+    dict as trace to collect the retrieved KB ids and model latency per block.
+    """
+    return [
+        run_block(block, llm, writer, trace)
+        for block in prepare_blocks(
+            query_index, query, retriever, RAG_prompt, RAG_prompt_with_variable, weights, router
+        )
+    ]
+
+
+def provenance(retrieved_docs, started: float) -> dict:
+    """Retrieved KB entry ids and model latency of one detection call"""
+    kb_ids = [kb_id for text, score, kb_id in retrieved_docs if kb_id is not None]
+    return {
+        "kb_ids": list(dict.fromkeys(kb_ids)),
+        "latency_ms": round((time.perf_counter() - started) * 1000, 1),
+    }
+
+
+def detection_records(file_name: str, query_index: int, query: str, detections, trace: dict) -> List[dict]:
+    """Per-line structured records of one function's detection results"""
+    input_lines = query.strip().split("\n")
+    step = BLOCK_SIZE - BLOCK_OVERLAP
+    blocks = split_into_blocks(input_lines)
+    block_results = []
+    for block_index, RAG_result in detections:
+        if block_index is None:
+            block_results.append((None, 0, input_lines, RAG_result, trace.get(None, {})))
+        else:
+            block_results.append(
+                (block_index, block_index * step, blocks[block_index], RAG_result, trace.get(block_index, {}))
+            )
+    return function_records(file_name, query_index, input_lines, block_results)
 
-    return blocks
+
+def format_detections(query_index: int, detections) -> List[str]:
+    """Answer file entries of one function; a block whose detection failed gets FAILED_MARKER instead of a result"""
+    entries = []
+    for block_index, RAG_result in detections:
+        if RAG_result is None:
+            RAG_result = FAILED_MARKER
+        if block_index is None:
+            entries.append(f"Query {query_index + 1}:\n{RAG_result}\n")
+        else:
+            entries.append(f"Query {query_index + 1}, Block {block_index + 1}:\n{RAG_result}\n")
+    return entries
 
 
 def process_queries(
@@ -86,143 +401,269 @@ def process_queries(
         llm,
         RAG_prompt,
         RAG_prompt_with_variable,
+        weights=None,
+        triage=None,
+        router=None,
 ):
     """Process all queries in the file"""
     try:
-        queries = read_queries(file_path)
+        with PROFILER.stage("read_queries"):
+            queries = read_queries(file_path)
     except Exception:
         return
 
-    RAG_results = []
-
-    for query_index, query in enumerate(queries):
-        sub_queries = query.strip().split("\n")
-        query_line_count = len(sub_queries)
-
-        # Decide processing method based on query line count
-        if query_line_count > 50:
-            # More than 50 lines, perform variable name extraction and block processing
-            try:
-                variable_names = variabledependency.generate_and_query_llm("\n".join(sub_queries))
-            except Exception:
-                variable_names = ""
-
-            # Process queries in blocks
-            blocks = split_into_blocks(sub_queries)
-
-            for block_index, block in enumerate(blocks):
-                # Pattern matching
-                try:
-                    matched_lines = match_patterns(block)
-                except Exception:
-                    continue
-
-                # Retrieve relevant documents
-                try:
-                    retrieved_docs = retrieve_documents(retriever, matched_lines)
-                except Exception:
-                    continue
-
-                # Remove duplicate documents
-                unique_retrieved_docs = list(dict.fromkeys(retrieved_docs))
-
-                context = format_docs(unique_retrieved_docs)
-
-                # Log retrieval
-                append_to_retrieve_log("retrieve-new.txt", "\n".join(block), context)
-
-                # Build variables dictionary
-                variables = {
-                    "Variable_names": variable_names,
-                    "context": context,
-                    "question": "\n".join(block),
-                }
-
-                # Build RAG chain
-                RAG_chain = (
-                        {
-                            "Variable_names": RunnablePassthrough(),
-                            "context": RunnablePassthrough(),
-                            "question": RunnablePassthrough(),
-                        }
-                        | RAG_prompt_with_variable
-                        | llm
-                        | StrOutputParser()
-                )
-
-                # Generate complete prompt and output
-                full_prompt = RAG_prompt_with_variable.format(**variables)
-                print(f"\n[Prompt for Query {query_index + 1}, Block {block_index + 1}]:\n{full_prompt}\n")
-
-                # Call model to generate result
-                try:
-                    RAG_result = RAG_chain.invoke(variables).strip()
-                    RAG_results.append(
-                        f"Query {query_index + 1}, Block {block_index + 1}:\n{RAG_result}\n"
+    base_filename = os.path.basename(file_path).split('.')[0]
+    RAG_output_path = os.path.join(output_dir, f"{base_filename}_RAG_answer.txt")
+    ledger = get_ledger()
+
+    # Optional structured output: one JSONL record per input line, written as each function finishes
+    records_writer = None
+    if load_config("OUTPUT", "jsonl", "false").lower() == "true":
+        records_writer = JsonlWriter(os.path.join(output_dir, f"{base_filename}_RAG_answer.jsonl"))
+
+    def prepared_functions():
+        """Pattern matching, retrieval and prompt building for each function, ahead of the detection calls"""
+        for query_index, query in enumerate(queries):
+            ledger.set_context(base_filename, f"Query {query_index + 1}")
+            if triage is not None and triage.route(query.strip().split("\n"))[0] == "skip":
+                yield query_index, query, []
+                continue
+            with PROFILER.stage("prepare_function"):
+                blocks = list(
+                    prepare_blocks(
+                        query_index, query, retriever, RAG_prompt, RAG_prompt_with_variable, weights, router
                     )
-                except Exception:
-                    continue
+                )
+            yield query_index, query, blocks
+
+    def detect(query_index, query, blocks, writer=None):
+        with PROFILER.stage("process_function"):
+            return detect_function(query_index, query, blocks, writer)
+
+    def detect_function(query_index, query, blocks, writer=None):
+        ledger.set_context(base_filename, f"Query {query_index + 1}")
+        trace = {}
+        run_detection = lambda model: [run_block(block, model, writer, trace) for block in blocks]
+        if triage is None:
+            detections = run_detection(llm)
         else:
-            # Less than or equal to 50 lines, process directly
-            # Pattern matching
-            try:
-                matched_lines = match_patterns(sub_queries)
-            except Exception:
-                continue
+            detections, route = triage.run(base_filename, query_index, query, llm, run_detection)
+            if route == "skip" and writer is not None:
+                # Keep the skipped function, unlabelled, in the streamed answer file
+                writer.begin(f"Query {query_index + 1}")
+                writer.write_lines(query.strip().split("\n"))
+                writer.end()
+        if records_writer is not None:
+            records_writer.write(detection_records(base_filename, query_index, query, detections, trace))
+        return detections
+
+    # With prefetch, the next functions are prepared in a background thread while the model answers.
+    # The memory profiler traces the whole process, so its stages must not overlap: no prefetch while profiling
+    prefetch = 0 if PROFILER.enabled else int(load_config("LLM", "prefetch", "0"))
+    functions = Prefetcher(prepared_functions(), prefetch) if prefetch > 0 else prepared_functions()
 
-            # Retrieve relevant documents
+    try:
+        if load_config("LLM", "stream", "false").lower() == "true":
+            # Streaming mode writes each labelled line to the answer file as the model produces it
+            with open(RAG_output_path, "w", encoding="utf-8") as f:
+                writer = ResultStreamWriter(f)
+                for query_index, query, blocks in functions:
+                    detect(query_index, query, blocks, writer)
+            return
+
+        RAG_results = []
+        budget_error = None
+
+        for query_index, query, blocks in functions:
             try:
-                retrieved_docs = retrieve_documents(retriever, matched_lines)
-            except Exception:
-                continue
+                detections = detect(query_index, query, blocks)
+            except (BudgetExceededError, CircuitOpenError) as e:
+                # Keep the results so far, then stop the run
+                budget_error = e
+                break
+            RAG_results.extend(format_detections(query_index, detections))
+
+        # Write results to output file
+        try:
+            write_output(RAG_output_path, "\n/////\n".join(RAG_results))
+        except Exception:
+            pass
+
+        if budget_error is not None:
+            raise budget_error
+    finally:
+        functions.close()
+        if records_writer is not None:
+            records_writer.close()
+            if load_config("OUTPUT", "parquet", "false").lower() == "true":
+                export_parquet(records_writer.file_path, os.path.join(output_dir, f"{base_filename}_RAG_answer.parquet"))
+
+
+def init_retriever(knowledge_base_file: str):
+    """Load the knowledge base and build its retriever"""
+    # Load knowledge base
+    try:
+        with PROFILER.stage("load_knowledge_base"):
+            fidelity_content = load_document(knowledge_base_file)
+            fidelity_documents = split_document(fidelity_content)
+            fidelity_texts = [doc.page_content for doc in fidelity_documents]
+    except Exception as e:
+        print(f"Error loading knowledge base: {e}")
+        sys.exit(1)
 
-            # Remove duplicate documents
-            unique_retrieved_docs = list(dict.fromkeys(retrieved_docs))
+    # Create embeddings and retriever
+    try:
+        with PROFILER.stage("build_vectorstore"):
+            embeddings = create_embedding(fidelity_texts)
+            db = create_vectorstore(fidelity_texts, embeddings)
+            retriever = create_retriever(db)
+    except Exception as e:
+        print(f"Error creating embeddings/retriever: {e}")
+        sys.exit(1)
 
-            context = format_docs(unique_retrieved_docs)
+    return retriever
 
-            # Log retrieval
-            append_to_retrieve_log("retrieve-new.txt", "\n".join(matched_lines), context)
 
-            # Build variables dictionary
-            variables = {
-                "context": context,
-                "question": query,
-            }
+def detection_templates():
+    """Detection prompt templates (whole function, and with redundant-variable hints) for the configured output mode"""
+    if compact_output_enabled():
+        return create_RAG_compact_prompt_template(), create_RAG_compact_promptwithvariable_template()
+    return create_RAG_prompt_template(), create_RAG_promptwithvariable_template()
 
-            # Build RAG chain
-            RAG_chain = (
-                    {
-                        "context": RunnablePassthrough(),
-                        "question": RunnablePassthrough()
-                    }
-                    | RAG_prompt
-                    | llm
-                    | StrOutputParser()
-            )
 
-            # Generate complete prompt and output
-            full_prompt = RAG_prompt.format(**variables)
-            print(f"\n[Prompt for Query {query_index + 1}]:\n{full_prompt}\n")
+def init_llm():
+    """Create the language model and detection prompt templates"""
+    set_llm_environment()
+    try:
+        from langchain_openai import ChatOpenAI
 
-            # Call model to generate result
-            try:
-                RAG_result = RAG_chain.invoke(variables).strip()
-                RAG_results.append(f"Query {query_index + 1}:\n{RAG_result}\n")
-            except Exception:
-                continue
+        model_name = load_config("LLM", "model")
+        temperature = float(load_config("LLM", "temperature"))
+        llm = ChatOpenAI(model=model_name, temperature=temperature)
+        RAG_prompt, RAG_prompt_with_variable = detection_templates()
+    except Exception as e:
+        print(f"Error initializing LLM or prompts: {e}")
+        sys.exit(1)
 
-    # Write results to output file
-    base_filename = os.path.basename(file_path).split('.')[0]
-    RAG_output_path = os.path.join(output_dir, f"{base_filename}_RAG_answer.txt")
-    try:
-        write_output(RAG_output_path, "\n/////\n".join(RAG_results))
-    except Exception:
-        pass
+    return llm, RAG_prompt, RAG_prompt_with_variable
+
+
+def queue_worker(queue_path: str, output_dir: str, knowledge_base_file: str, workers: int = 1):
+    """Pull function-level tasks from the work queue until it is empty, merging each file once it is finished
+
+    The local workers split [RATE_LIMIT] evenly, and the [BUDGET] is checked
+    against the tokens used by every worker of the queue.
+    """
+    work_queue = WorkQueue(
+        queue_path,
+        lease_seconds=float(load_config("QUEUE", "lease_seconds", "600")),
+        max_attempts=int(load_config("QUEUE", "max_attempts", "3")),
+    )
+    get_rate_limiter().share(workers)
+    get_ledger().share_usage(SharedUsage(queue_path))
+    weights = analyze_fidelity_file(knowledge_base_file)
+    retriever = init_retriever(knowledge_base_file)
+    llm, RAG_prompt, RAG_prompt_with_variable = init_llm()
+    triage = init_triage(knowledge_base_file, weights, output_dir)
+    router = init_router(knowledge_base_file, retriever, weights)
+    worker = worker_name()
+    structured_output = load_config("OUTPUT", "jsonl", "false").lower() == "true"
+
+    while True:
+        task = work_queue.claim(worker)
+        if task is None:
+            break
+        task_id, file_path, query_index, query = task
+        base_filename = os.path.basename(file_path).split('.')[0]
+        get_ledger().set_context(base_filename, f"Query {query_index + 1}")
+        trace = {}
+        run_detection = lambda model: detect_query(
+            query_index, query, retriever, model, RAG_prompt, RAG_prompt_with_variable, weights,
+            trace=trace, router=router,
+        )
+        try:
+            if triage is None:
+                detections = run_detection(llm)
+            else:
+                detections, _ = triage.run(base_filename, query_index, query, llm, run_detection)
+        except (BudgetExceededError, CircuitOpenError) as e:
+            # Leave the task for a worker with budget left, or for when the endpoint recovers
+            work_queue.release(task_id)
+            print(f"Stopping worker {worker}: {e}")
+            break
+        except Exception as e:
+            print(f"Error processing {file_path} query {query_index + 1}: {e}")
+            work_queue.release(task_id, failed=True)
+            continue
+        if any(RAG_result is None for block_index, RAG_result in detections):
+            # Requeue the function rather than store it incomplete; after max_attempts it is merged as failed
+            print(f"Error: detection of {file_path} query {query_index + 1} failed, returning it to the queue")
+            work_queue.release(task_id, failed=True)
+            continue
+        records = None
+        if structured_output:
+            records = detection_records(base_filename, query_index, query, detections, trace)
+        work_queue.complete(task_id, "\n/////\n".join(format_detections(query_index, detections)), records)
+        for merged_file in work_queue.merge_finished(output_dir):
+            print(f"Merged results of {merged_file}")
+
+    print(get_rate_limiter().report())
+    print(get_ledger().report())
+    if triage is not None:
+        print(triage.report())
+    if router is not None:
+        print(router.report())
+    work_queue.close()
+
+
+def run_queue(queue_path: str, testdata_dir: str, output_dir: str, knowledge_base_file: str, workers: int):
+    """Queue the input directory (once) and process it with local worker processes
+
+    Workers claim the costliest functions first; progress, throughput and ETA
+    are printed every [QUEUE] progress_seconds until they finish.
+    """
+    work_queue = WorkQueue(queue_path)
+    print(f"Queued {work_queue.enqueue_directory(testdata_dir)} new functions in {queue_path}")
+    reporter = ProgressReporter(work_queue.progress())
+    progress_seconds = float(load_config("QUEUE", "progress_seconds", "30"))
+
+    processes = [
+        multiprocessing.Process(target=queue_worker, args=(queue_path, output_dir, knowledge_base_file, workers))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    running = processes
+    while running:
+        running[0].join(progress_seconds)
+        running = [process for process in running if process.is_alive()]
+        print(reporter.line(work_queue.progress()))
+
+    # Workers merge files as they finish; this catches files whose last task failed
+    work_queue.merge_finished(output_dir)
+    print(f"Queue status: {work_queue.counts()}")
+    print(f"Tokens used by all workers: {SharedUsage(queue_path).total()}")
+    work_queue.close()
 
 
 def main():
     """Main function, initialize environment and process files"""
+    parser = argparse.ArgumentParser(description="Detect decompilation distortions.")
+    parser.add_argument('--queue', type=str, default=None,
+                        help="SQLite work queue file; workers sharing it split the input by function.")
+    parser.add_argument('--workers', type=int, default=1, help="Local worker processes in queue mode.")
+    parser.add_argument('--batch', action='store_true',
+                        help="Submit all detection prompts as one Batch API job, wait for it and write the answer files.")
+    parser.add_argument('--profile-memory', action='store_true',
+                        help="Trace allocations per stage and report top allocation sites and peak RSS.")
+    args = parser.parse_args()
+
+    if args.profile_memory and args.queue:
+        # Each queue worker is a process of its own, outside the profiler of this one
+        parser.error("--profile-memory cannot be combined with --queue; profile a plain or --batch run instead")
+    if args.profile_memory:
+        PROFILER.start()
+
     current_dir = os.getcwd()
 
     # Load paths from config
@@ -233,40 +674,57 @@ def main():
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    # Load knowledge base
-    try:
-        fidelity_content = load_document(knowledge_base_file)
-        fidelity_documents = split_document(fidelity_content)
-        fidelity_texts = [doc.page_content for doc in fidelity_documents]
-    except Exception as e:
-        print(f"Error loading knowledge base: {e}")
-        sys.exit(1)
+    if args.queue:
+        run_queue(args.queue, testdata_dir, output_dir, knowledge_base_file, args.workers)
+        return
 
-    # Create embeddings and retriever
-    try:
-        embeddings = create_embedding(fidelity_texts)
-        db = create_vectorstore(fidelity_texts, embeddings)
-        retriever = create_retriever(db)
-    except Exception as e:
-        print(f"Error creating embeddings/retriever: {e}")
-        sys.exit(1)
+    # Load knowledge base, pattern weights and retriever
+    weights = analyze_fidelity_file(knowledge_base_file)
+    retriever = init_retriever(knowledge_base_file)
+    # Optional per-function routing to the knowledge base of the function's decompiler
+    router = init_router(knowledge_base_file, retriever, weights)
+
+    if args.batch:
+        from batch import run_batch
+
+        run_batch(testdata_dir, output_dir, retriever, *detection_templates(), weights, router)
+        print(get_ledger().report())
+        report = {"tokens": get_ledger().to_dict()}
+        if PROFILER.enabled:
+            print(PROFILER.report())
+            report["memory"] = PROFILER.to_dict()
+        write_run_report(output_dir, report)
+        return
 
     # Initialize language model and prompt templates
-    try:
-        model_name = load_config("LLM", "model")
-        temperature = float(load_config("LLM", "temperature"))
-        llm = ChatOpenAI(model=model_name, temperature=temperature)
-        RAG_prompt = create_RAG_prompt_template()
-        RAG_prompt_with_variable = create_RAG_promptwithvariable_template()
-    except Exception as e:
-        print(f"Error initializing LLM or prompts: {e}")
-        sys.exit(1)
+    llm, RAG_prompt, RAG_prompt_with_variable = init_llm()
+    triage = init_triage(knowledge_base_file, weights, output_dir)
 
     # Process test data
-    for root, dirs, files in os.walk(testdata_dir):
-        for file in files:
-            file_path = os.path.join(root, file)
-            process_queries(file_path, output_dir, retriever, llm, RAG_prompt, RAG_prompt_with_variable)
+    try:
+        for root, dirs, files in os.walk(testdata_dir):
+            for file in files:
+                file_path = os.path.join(root, file)
+                process_queries(
+                    file_path, output_dir, retriever, llm, RAG_prompt, RAG_prompt_with_variable, weights, triage,
+                    router,
+                )
+    except (BudgetExceededError, CircuitOpenError) as e:
+        print(f"Stopping: {e}")
+
+    print(get_rate_limiter().report())
+    print(get_ledger().report())
+    report = {"tokens": get_ledger().to_dict(), "rate_limit": get_rate_limiter().to_dict()}
+    if triage is not None:
+        print(triage.report())
+        report["triage"] = triage.stats
+    if router is not None:
+        print(router.report())
+        report["dialects"] = router.stats
+    if PROFILER.enabled:
+        print(PROFILER.report())
+        report["memory"] = PROFILER.to_dict()
+    write_run_report(output_dir, report)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,114 @@
+import re
+from document_processor import normalize_code_line
+
+QUERY_HEADER_PATTERN = re.compile(r'^Query (\d+)(?:, Block \d+)?:\s*$')
+
+
+def normalize_line(line):
+    """Comparison key for a code line: labels and all whitespace removed"""
+    return re.sub(r'\s+', '', normalize_code_line(line))
+
+
+def split_functions(content):
+    """Split ///// separated content into functions, each a list of lines
+
+    Detection output headers ("Query N:" / "Query N, Block M:") are dropped, and
+    consecutive blocks of the same query are joined back into one function.
+    """
+    functions = []
+    query_ids = []
+    for section in content.split("/////"):
+        lines = section.strip("\n").split("\n")
+        while lines and not lines[0].strip():
+            lines.pop(0)
+        query_id = None
+        if lines:
+            header = QUERY_HEADER_PATTERN.match(lines[0].strip())
+            if header:
+                query_id = header.group(1)
+                lines = lines[1:]
+        if not any(line.strip() for line in lines):
+            continue
+        if query_id is not None and query_ids and query_ids[-1] == query_id:
+            functions[-1].extend(lines)
+        else:
+            functions.append(lines)
+            query_ids.append(query_id)
+    return functions
+
+
+def myers_diff(a, b):
+    """Longest common subsequence of two sequences with Myers' O(ND) algorithm
+
+    Returns the matched (index_in_a, index_in_b) pairs in order. Equal elements
+    are matched one to one, so repeated lines are never collapsed.
+    """
+    n, m = len(a), len(b)
+    if n == 0 or m == 0:
+        return []
+
+    offset = n + m + 1
+    v = [0] * (2 * offset + 1)
+    trace = []
+    for d in range(n + m + 1):
+        # Keep the diagonals -(d+1)..d+1 read by this step; trace[d][j + d + 1] is diagonal j
+        trace.append(v[offset - d - 1:offset + d + 2])
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                return _backtrack(trace, n, m)
+    return []
+
+
+def _backtrack(trace, n, m):
+    """Walk the saved diagonals back from (n, m), collecting the matched pairs"""
+    x, y = n, m
+    matches = []
+    for d in range(len(trace) - 1, -1, -1):
+        previous = trace[d]
+        k = x - y
+        if k == -d or (k != d and previous[k - 1 + d + 1] < previous[k + 1 + d + 1]):
+            previous_k = k + 1
+        else:
+            previous_k = k - 1
+        previous_x = previous[previous_k + d + 1]
+        previous_y = previous_x - previous_k
+
+        while x > previous_x and y > previous_y:
+            x -= 1
+            y -= 1
+            matches.append((x, y))
+        if d > 0:
+            x, y = previous_x, previous_y
+    matches.reverse()
+    return matches
+
+
+def align_lines(gt_lines, model_lines):
+    """Map model line indices to ground-truth line indices within one function"""
+    gt_keys = [normalize_line(line) for line in gt_lines]
+    model_keys = [normalize_line(line) for line in model_lines]
+    return [
+        (gt_index, model_index)
+        for gt_index, model_index in myers_diff(gt_keys, model_keys)
+        if gt_keys[gt_index]
+    ]
+
+
+def align_functions(gt_functions, model_functions):
+    """Pair functions by a diff over their signatures, so missing or extra functions do not shift the rest"""
+    def signature(lines):
+        return next((normalize_line(line) for line in lines if normalize_line(line)), "")
+
+    return myers_diff(
+        [signature(lines) for lines in gt_functions],
+        [signature(lines) for lines in model_functions],
+    )
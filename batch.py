@@ -0,0 +1,298 @@
+import os
+import json
+import time
+from config import load_config
+from document_processor import BLOCK_SIZE, read_queries, split_into_blocks, write_output
+from structured_output import JsonlWriter
+from compact_output import apply_compact_labels, compact_output_enabled
+from token_counter import get_ledger
+from memory_profile import PROFILER
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+REQUESTS_FILE = "batch_requests.jsonl"
+MANIFEST_FILE = "batch_manifest.json"
+STATE_FILE = "batch_state.json"
+RESULTS_FILE = "batch_results.jsonl"
+RETRY_FILE = "batch_retry_requests.jsonl"
+
+
+def custom_id(file_index: int, query_index: int, block_index) -> str:
+    return f"{file_index}:{query_index}:{'-' if block_index is None else block_index}"
+
+
+def parse_custom_id(value: str) -> tuple:
+    file_index, query_index, block_index = value.split(":")
+    return int(file_index), int(query_index), None if block_index == "-" else int(block_index)
+
+
+def batch_request(request_id: str, prompt: str) -> dict:
+    """One line of an OpenAI Batch API input file: the detection prompt as a chat completion request"""
+    return {
+        "custom_id": request_id,
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": {
+            "model": load_config("LLM", "model"),
+            "temperature": float(load_config("LLM", "temperature")),
+            "messages": [{"role": "user", "content": prompt}],
+        },
+    }
+
+
+def write_batch_requests(
+        input_dir: str, output_dir: str, retriever, RAG_prompt, RAG_prompt_with_variable, weights=None, router=None
+):
+    """Render the detection prompt of every block of the input corpus into a batch input file
+
+    The manifest records the files and the blocks of each function, so the
+    results can be put back in order; blocks whose preparation failed are
+    not requested and come back as failed detections. With a [BUDGET], each
+    request is estimated like a synchronous call, and once the estimates
+    reach the remaining budget the later blocks are not requested either.
+    """
+    from FidelityGPT import detection_tokens, prepare_blocks
+
+    # Compact answers are expanded against their input lines when the results are ingested
+    manifest = {"files": [], "compact": compact_output_enabled()}
+    requests_path = os.path.join(output_dir, REQUESTS_FILE)
+    ledger = get_ledger()
+    planned = 0
+    over_budget = False
+    count = 0
+    with open(requests_path, "w", encoding="utf-8") as f:
+        for root, dirs, files in os.walk(input_dir):
+            for file in sorted(files):
+                file_path = os.path.join(root, file)
+                try:
+                    queries = read_queries(file_path)
+                except Exception:
+                    continue
+                file_index = len(manifest["files"])
+                functions = []
+                for query_index, query in enumerate(queries):
+                    if over_budget:
+                        # Keep the block layout so the function comes back as failed, in order
+                        lines = query.strip().split("\n")
+                        functions.append(list(range(len(split_into_blocks(lines)))) if len(lines) > BLOCK_SIZE else [None])
+                        continue
+                    block_indices = []
+                    with PROFILER.stage("prepare_function"):
+                        blocks = list(prepare_blocks(
+                            query_index, query, retriever, RAG_prompt, RAG_prompt_with_variable, weights, router
+                        ))
+                    for block in blocks:
+                        block_indices.append(block["block_index"])
+                        if block["variables"] is None or over_budget:
+                            continue
+                        tokens = detection_tokens(block["variables"], block["full_prompt"], manifest["compact"])
+                        if ledger.max_tokens and ledger.budget_used() + planned + tokens > ledger.max_tokens:
+                            print(f"Token budget exhausted at {file_path} query {query_index + 1}: later blocks are not requested")
+                            over_budget = True
+                            continue
+                        planned += tokens
+                        request_id = custom_id(file_index, query_index, block["block_index"])
+                        f.write(json.dumps(batch_request(request_id, block["full_prompt"])) + "\n")
+                        count += 1
+                    functions.append(block_indices)
+                manifest["files"].append({"path": file_path, "functions": functions})
+
+    with open(os.path.join(output_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    print(f"Wrote {count} batch requests to {requests_path}")
+    return requests_path
+
+
+def missing_results(output_dir: str, results: dict) -> list:
+    """custom_ids of batch_requests.jsonl that have no result"""
+    with open(os.path.join(output_dir, REQUESTS_FILE), "r", encoding="utf-8") as f:
+        request_ids = [json.loads(line)["custom_id"] for line in f if line.strip()]
+    return [request_id for request_id in request_ids if results.get(request_id) is None]
+
+
+def write_retry_requests(output_dir: str, results: dict) -> str:
+    """Write the requests of batch_requests.jsonl that have no result yet into a batch input file of their own"""
+    missing = set(missing_results(output_dir, results))
+    retry_path = os.path.join(output_dir, RETRY_FILE)
+    with open(os.path.join(output_dir, REQUESTS_FILE), "r", encoding="utf-8") as requests, \
+            open(retry_path, "w", encoding="utf-8") as f:
+        for line in requests:
+            if line.strip() and json.loads(line)["custom_id"] in missing:
+                f.write(line)
+    print(f"Resubmitting {len(missing)} batch requests without a result")
+    return retry_path
+
+
+def batch_client():
+    """OpenAI client for the Batch API; [BATCH] base_url may point at a local stand-in"""
+    from openai import OpenAI
+
+    base_url = load_config("BATCH", "base_url", "") or load_config("LLM", "api_base")
+    return OpenAI(base_url=base_url, api_key=load_config("LLM", "api_key"))
+
+
+def submit_batch(client, requests_path: str) -> str:
+    with open(requests_path, "rb") as f:
+        input_file = client.files.create(file=f, purpose="batch")
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window=load_config("BATCH", "completion_window", "24h"),
+    )
+    print(f"Submitted batch {batch.id}")
+    return batch.id
+
+
+def wait_for_batch(client, batch_id: str):
+    """Poll the batch until it reaches a final status"""
+    poll_seconds = float(load_config("BATCH", "poll_seconds", "60"))
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        if counts is not None:
+            print(f"Batch {batch_id}: {batch.status}, {counts.completed}/{counts.total} completed, {counts.failed} failed")
+        else:
+            print(f"Batch {batch_id}: {batch.status}")
+        if batch.status in FINAL_STATUSES:
+            return batch
+        time.sleep(poll_seconds)
+
+
+def download_results(client, batch, output_dir: str) -> str:
+    """Append the batch output file and error file to the results file
+
+    The results of a batch that was resubmitted for its missing requests
+    are added to those of the earlier batches of the same corpus.
+    """
+    results_path = os.path.join(output_dir, RESULTS_FILE)
+    with open(results_path, "a", encoding="utf-8") as f:
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                f.write(client.files.content(file_id).text.rstrip("\n") + "\n")
+    return results_path
+
+
+def load_batch_results(results_path: str, charge: bool = True) -> dict:
+    """Map each custom_id to its completion text, or None when the request failed; token usage is charged to the ledger
+
+    A result from an earlier batch is not replaced by a later failure.
+    """
+    results = {}
+    with open(results_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            response = entry.get("response") or {}
+            body = response.get("body") or {}
+            if response.get("status_code") != 200 or not body.get("choices"):
+                print(f"Error: batch request {entry.get('custom_id')} failed: {entry.get('error') or body.get('error')}")
+                results.setdefault(entry["custom_id"], None)
+                continue
+            results[entry["custom_id"]] = body["choices"][0]["message"]["content"].strip()
+            usage = body.get("usage") or {}
+            if charge:
+                get_ledger().charge("detection", usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+    return results
+
+
+def ingest_results(results_path: str, output_dir: str):
+    """Write the answer files (and JSONL records when enabled) of a finished batch, in function order
+
+    Files none of whose requests succeeded are skipped rather than written empty.
+    """
+    from FidelityGPT import detection_records, format_detections
+
+    with open(os.path.join(output_dir, MANIFEST_FILE), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    results = load_batch_results(results_path)
+    structured_output = load_config("OUTPUT", "jsonl", "false").lower() == "true"
+
+    for file_index, entry in enumerate(manifest["files"]):
+        base_filename = os.path.basename(entry["path"]).split('.')[0]
+        # An answer file from an earlier run is kept when none of this file's requests came back
+        if not any(
+                results.get(custom_id(file_index, query_index, block_index)) is not None
+                for query_index, block_indices in enumerate(entry["functions"])
+                for block_index in block_indices
+        ):
+            print(f"Error: no batch results for {entry['path']}, leaving its answer file as it is")
+            continue
+        queries = read_queries(entry["path"])
+        records_writer = None
+        if structured_output:
+            records_writer = JsonlWriter(os.path.join(output_dir, f"{base_filename}_RAG_answer.jsonl"))
+        RAG_results = []
+        for query_index, block_indices in enumerate(entry["functions"]):
+            detections = [
+                (block_index, results.get(custom_id(file_index, query_index, block_index)))
+                for block_index in block_indices
+            ]
+            if manifest.get("compact"):
+                lines = queries[query_index].strip().split("\n")
+                blocks = split_into_blocks(lines)
+                detections = [
+                    (block_index, None if result is None else apply_compact_labels(
+                        lines if block_index is None else blocks[block_index], result
+                    ))
+                    for block_index, result in detections
+                ]
+            RAG_results.extend(format_detections(query_index, detections))
+            if records_writer is not None:
+                records_writer.write(detection_records(base_filename, query_index, queries[query_index], detections, {}))
+        write_output(os.path.join(output_dir, f"{base_filename}_RAG_answer.txt"), "\n/////\n".join(RAG_results))
+        if records_writer is not None:
+            records_writer.close()
+    print(f"Ingested {sum(result is not None for result in results.values())} batch results into {output_dir}")
+    return results
+
+
+def run_batch(
+        input_dir: str, output_dir: str, retriever, RAG_prompt, RAG_prompt_with_variable, weights=None, router=None
+):
+    """Prepare, submit, poll and ingest one batch
+
+    The batch id is kept in batch_state.json, so running again after an
+    interruption resumes polling instead of submitting the corpus twice.
+    A batch that ended failed, expired or cancelled has whatever finished
+    ingested, and running again submits only the requests without a result.
+    """
+    state_path = os.path.join(output_dir, STATE_FILE)
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+
+    client = batch_client()
+    if state.get("status") == "submitted":
+        print(f"Resuming batch {state['batch_id']}")
+    else:
+        results_path = os.path.join(output_dir, RESULTS_FILE)
+        if state.get("status") == "partial":
+            requests_path = write_retry_requests(output_dir, load_batch_results(results_path, charge=False))
+        else:
+            # A new corpus run starts without the results of the last one
+            if os.path.exists(results_path):
+                os.remove(results_path)
+            requests_path = write_batch_requests(
+                input_dir, output_dir, retriever, RAG_prompt, RAG_prompt_with_variable, weights, router
+            )
+        state = {"batch_id": submit_batch(client, requests_path), "status": "submitted"}
+        with open(state_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+
+    batch = wait_for_batch(client, state["batch_id"])
+    with PROFILER.stage("ingest_results"):
+        results = ingest_results(download_results(client, batch, output_dir), output_dir)
+    missing = missing_results(output_dir, results)
+    if batch.status == "completed" or not missing:
+        # Requests that failed in a completed batch are answered as failed detections
+        state["status"] = "ingested"
+    else:
+        print(
+            f"Error: batch {batch.id} ended with status {batch.status}, {len(missing)} requests have no result: "
+            f"{', '.join(missing[:10])}{' ...' if len(missing) > 10 else ''}. Run again to submit only those"
+        )
+        state["status"] = "partial"
+    with open(state_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
@@ -0,0 +1,316 @@
+import io
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import statistics
+import subprocess
+from contextlib import redirect_stdout
+
+CUR_DIR = os.path.dirname(os.path.abspath(__file__))
+DATASET_DIR = os.path.join(CUR_DIR, "Dataset")
+GROUND_TRUTH_DIR = os.path.join(CUR_DIR, "Ground truth")
+KNOWLEDGE_BASES = ["fidelity_new.c", "fidelity_ghidra.c"]
+
+# Statements timed in a fresh interpreter; "interpreter" is the baseline cost of starting Python
+STARTUP_TARGETS = {
+    "interpreter": "pass",
+    "FidelityGPT": "import FidelityGPT",
+    "Correction": "import Correction",
+    "variabledependency": "import variabledependency",
+    "pattern_matcher": "import pattern_matcher",
+    "pipeline": "import pipeline",
+    "Evaluation": "import runpy; runpy.run_path('Evaluation/Evaluation.py', run_name='benchmark')",
+}
+
+# Workloads run in a fresh interpreter for the memory benchmark
+MEMORY_TARGETS = {
+    "interpreter": "pass",
+    "import.FidelityGPT": "import FidelityGPT",
+    "read_queries.Dataset": "import benchmark; benchmark.load_dataset_functions()",
+    "process.Dataset": "import benchmark; benchmark.process_dataset_locally()",
+}
+MEMORY_PROBE = """
+import json, sys, tracemalloc
+from memory_profile import peak_rss_mb
+if sys.argv[1] == "traced":
+    tracemalloc.start()
+exec(sys.argv[2])
+traced_peak = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else 0
+print(json.dumps({"peak_rss_mb": peak_rss_mb(), "traced_peak_mb": traced_peak / 2 ** 20}))
+"""
+
+
+def use_corpus(corpus_dir: str):
+    """Run the Dataset benchmarks over a generated corpus (see synthetic_corpus.py) instead of the bundled one"""
+    global DATASET_DIR, GROUND_TRUTH_DIR
+    DATASET_DIR = os.path.join(os.path.abspath(corpus_dir), "Dataset")
+    GROUND_TRUTH_DIR = os.path.join(os.path.abspath(corpus_dir), "Ground truth")
+
+
+def time_startup(statement: str, repeat: int) -> list:
+    """Time a statement in a fresh interpreter, returning one duration per run in seconds"""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", statement], cwd=CUR_DIR, check=True)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def summarize(durations: list) -> dict:
+    """Reduce run durations to milliseconds statistics"""
+    return {
+        "runs": len(durations),
+        "median_ms": round(statistics.median(durations) * 1000, 3),
+        "min_ms": round(min(durations) * 1000, 3),
+        "max_ms": round(max(durations) * 1000, 3),
+    }
+
+
+def run_startup(repeat: int) -> dict:
+    """Measure CLI startup (interpreter plus module import) for each entry point"""
+    results = {}
+    for name, statement in STARTUP_TARGETS.items():
+        results[f"startup.{name}"] = summarize(time_startup(statement, repeat))
+    return results
+
+
+def time_calls(func, repeat: int) -> list:
+    """Time repeated calls of func, silencing the progress output of the code under test"""
+    durations = []
+    with redirect_stdout(io.StringIO()):
+        func()  # warm up caches and lazy imports
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            durations.append(time.perf_counter() - start)
+    return durations
+
+
+def load_dataset_functions() -> list:
+    """All functions of the bundled Dataset, in file order"""
+    from document_processor import read_queries
+
+    functions = []
+    with redirect_stdout(io.StringIO()):
+        for file_path in sorted(glob.glob(os.path.join(DATASET_DIR, "*.txt"))):
+            functions.extend(read_queries(file_path))
+    return functions
+
+
+def process_dataset_locally():
+    """Every local stage of detection over the whole Dataset, keeping the results as a run would"""
+    from pattern_matcher import analyze_fidelity_file, match_patterns
+    from FidelityGPT import detection_records, format_detections
+    from document_processor import split_into_blocks
+    import variabledependency
+
+    weights = analyze_fidelity_file(os.path.join(CUR_DIR, KNOWLEDGE_BASES[0]))
+    results = []
+    records = []
+    with redirect_stdout(io.StringIO()):
+        for query_index, query in enumerate(load_dataset_functions()):
+            lines = query.strip().split("\n")
+            if len(lines) > 50:
+                pdg, pdg_lines = variabledependency.generate_pdg(query)
+                for var in sorted(set(variabledependency.extract_variable_definitions(query))):
+                    variabledependency.find_variable_dependencies(pdg, var, pdg_lines)
+                detections = [(block_index, "\n".join(block)) for block_index, block in enumerate(split_into_blocks(lines))]
+                for block in split_into_blocks(lines):
+                    match_patterns(block, weights=weights)
+            else:
+                match_patterns(lines, weights=weights)
+                detections = [(None, query)]
+            # The input stands in for the model answer
+            results.extend(format_detections(query_index, detections))
+            records.extend(detection_records("Dataset", query_index, query, detections, {}))
+    return results, records
+
+
+def measure_memory(statement: str) -> dict:
+    """Peak RSS of a fresh interpreter running the statement, and its tracemalloc peak in a second run"""
+    measured = {}
+    for mode in ("rss", "traced"):
+        output = subprocess.run(
+            [sys.executable, "-c", MEMORY_PROBE, mode, statement],
+            cwd=CUR_DIR, check=True, capture_output=True, text=True,
+        ).stdout
+        values = json.loads(output.strip().splitlines()[-1])
+        if mode == "rss":
+            measured["peak_rss_mb"] = round(values["peak_rss_mb"], 3)
+        else:
+            measured["traced_peak_mb"] = round(values["traced_peak_mb"], 3)
+    return measured
+
+
+def run_memory(corpus_dir: str = None) -> dict:
+    """Measure the memory footprint of each workload in its own interpreter"""
+    results = {}
+    for name, statement in MEMORY_TARGETS.items():
+        print(f"Running {name}")
+        if corpus_dir:
+            statement = f"import benchmark; benchmark.use_corpus({os.path.abspath(corpus_dir)!r}); {statement}"
+        results[f"memory.{name}"] = measure_memory(statement)
+    return results
+
+
+def run_hot_paths(repeat: int) -> dict:
+    """Time the local (no network) hot paths over the bundled Dataset and both knowledge bases"""
+    from document_processor import read_queries, split_into_blocks
+    from pattern_matcher import analyze_fidelity_file, match_patterns
+    import variabledependency
+
+    sys.path.insert(0, os.path.join(CUR_DIR, "Evaluation"))
+    import Evaluation
+
+    functions = load_dataset_functions()
+    function_lines = [query.strip().split("\n") for query in functions]
+    long_functions = [query for query, lines in zip(functions, function_lines) if len(lines) > 50]
+    dataset_files = sorted(glob.glob(os.path.join(DATASET_DIR, "*.txt")))
+    weights = analyze_fidelity_file(os.path.join(CUR_DIR, KNOWLEDGE_BASES[0]))
+
+    def pdg_and_dependencies():
+        for query in long_functions:
+            pdg, lines = variabledependency.generate_pdg(query)
+            for var in sorted(set(variabledependency.extract_variable_definitions(query))):
+                variabledependency.find_variable_dependencies(pdg, var, lines)
+
+    benchmarks = {
+        "read_queries": lambda: [read_queries(file_path) for file_path in dataset_files],
+        "match_patterns": lambda: [match_patterns(lines, weights=weights) for lines in function_lines],
+        "split_into_blocks": lambda: [split_into_blocks(lines) for lines in function_lines],
+        "cfg_post_dominators": lambda: [
+            variabledependency.compute_post_dominators(variabledependency.generate_cfg(query)[0]) for query in functions
+        ],
+        "generate_pdg": lambda: [variabledependency.generate_pdg(query) for query in long_functions],
+        "find_variable_dependencies": pdg_and_dependencies,
+        "find_redundant_variables": lambda: [variabledependency.find_redundant_variables(query) for query in long_functions],
+    }
+    for knowledge_base in KNOWLEDGE_BASES:
+        knowledge_base_file = os.path.join(CUR_DIR, knowledge_base)
+        benchmarks[f"analyze_fidelity_file.{knowledge_base}"] = lambda path=knowledge_base_file: analyze_fidelity_file(path)
+
+    # Evaluation comparators: ground truth against the unlabelled Dataset it was annotated from
+    pairs = Evaluation.find_file_pairs(GROUND_TRUTH_DIR, DATASET_DIR)
+    contents = [(Evaluation.read_file(gt_file), Evaluation.read_file(model_file)) for gt_file, model_file in pairs]
+    annotations = [
+        (Evaluation.extract_lines_with_annotations(gt), Evaluation.extract_lines_with_annotations(model))
+        for gt, model in contents
+    ]
+    benchmarks["evaluation.compare_annotations"] = lambda: [
+        Evaluation.compare_annotations(gt, model) for gt, model in annotations
+    ]
+    benchmarks["evaluation.compare_annotations_by_label"] = lambda: [
+        Evaluation.compare_annotations_by_label(gt, model) for gt, model in annotations
+    ]
+    benchmarks["evaluation.align_annotations"] = lambda: [
+        Evaluation.compare_aligned_annotations(*Evaluation.align_annotations(gt, model)) for gt, model in contents
+    ]
+
+    results = {}
+    for name, func in benchmarks.items():
+        print(f"Running {name}")
+        results[f"hot.{name}"] = summarize(time_calls(func, repeat))
+    return results
+
+
+def metric(stats: dict) -> str:
+    """The compared value of a result: median time, or peak RSS for memory benchmarks"""
+    return "median_ms" if "median_ms" in stats else "peak_rss_mb"
+
+
+def compare_results(baseline: dict, current: dict, threshold: float) -> list:
+    """Print median time (or peak RSS) changes against the baseline and return the benchmarks that regressed"""
+    regressions = []
+    print(f"{'benchmark':<46} {'baseline':>12} {'current':>12} {'change':>9}")
+    for name, stats in current.items():
+        value = stats[metric(stats)]
+        if name not in baseline:
+            print(f"{name:<46} {'-':>12} {value:>12.3f} {'new':>9}")
+            continue
+        before = baseline[name][metric(stats)]
+        change = (value - before) / before if before else 0.0
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<46} {before:>12.3f} {value:>12.3f} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def load_results(file_path: str) -> dict:
+    with open(file_path, "r", encoding="utf-8") as f:
+        return json.load(f)["results"]
+
+
+def print_results(results: dict):
+    if any(metric(stats) == "peak_rss_mb" for stats in results.values()):
+        print(f"{'benchmark':<46} {'peak RSS MB':>12} {'traced MB':>12}")
+        for name, stats in results.items():
+            print(f"{name:<46} {stats['peak_rss_mb']:>12.3f} {stats['traced_peak_mb']:>12.3f}")
+        return
+    print(f"{'benchmark':<46} {'median ms':>12} {'min ms':>12} {'max ms':>12}")
+    for name, stats in results.items():
+        print(f"{name:<46} {stats['median_ms']:>12.3f} {stats['min_ms']:>12.3f} {stats['max_ms']:>12.3f}")
+
+
+def save_results(file_path: str, results: dict):
+    with open(file_path, "w", encoding="utf-8") as f:
+        json.dump({"python": sys.version.split()[0], "results": results}, f, indent=2)
+    print(f"Results written to {file_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FidelityGPT benchmarks (no network access required).")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    startup_parser = subparsers.add_parser("startup", help="Time interpreter start plus module import.")
+    startup_parser.add_argument('--repeat', type=int, default=10, help="Fresh interpreters per entry point.")
+    startup_parser.add_argument('--output', type=str, default=None, help="Write results as JSON.")
+
+    run_parser = subparsers.add_parser("run", help="Time the local hot paths over Dataset/ and the KB files.")
+    run_parser.add_argument('--repeat', type=int, default=5, help="Timed runs per benchmark.")
+    run_parser.add_argument('--output', type=str, default=None, help="Write results as JSON.")
+    run_parser.add_argument('--corpus', type=str, default=None,
+                            help="Generated corpus directory (Dataset/ and Ground truth/) to use instead of the bundled one.")
+
+    memory_parser = subparsers.add_parser("memory", help="Peak RSS and traced peak of the Dataset workloads.")
+    memory_parser.add_argument('--output', type=str, default=None, help="Write results as JSON.")
+    memory_parser.add_argument('--corpus', type=str, default=None,
+                               help="Generated corpus directory to use instead of the bundled one.")
+
+    compare_parser = subparsers.add_parser("compare", help="Flag regressions of a result file against a baseline.")
+    compare_parser.add_argument('baseline', type=str, help="Stored baseline JSON.")
+    compare_parser.add_argument('current', type=str, help="New results JSON.")
+    compare_parser.add_argument('--threshold', type=float, default=0.2,
+                                help="Allowed median slowdown or peak RSS growth (0.2 = 20%%).")
+
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        regressions = compare_results(load_results(args.baseline), load_results(args.current), args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+            sys.exit(1)
+        print("No regressions")
+        return
+
+    if args.command == "startup":
+        results = run_startup(args.repeat)
+    elif args.command == "run":
+        if args.corpus:
+            use_corpus(args.corpus)
+        results = run_hot_paths(args.repeat)
+    elif args.command == "memory":
+        results = run_memory(args.corpus)
+
+    print_results(results)
+    if args.output:
+        save_results(args.output, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import re
+from config import load_config
+
+# "12: I1" or "12: I1, I4"; anything else on a line is ignored
+COMPACT_LINE_PATTERN = re.compile(r'^\s*(?:line\s*)?(\d+)\s*[:.)-]\s*(.*)$', re.IGNORECASE)
+COMPACT_LABEL_PATTERN = re.compile(r'\bI[1-6]\b')
+
+
+def compact_output_enabled() -> bool:
+    return load_config("LLM", "compact_output", "false").lower() == "true"
+
+
+def number_lines(lines) -> str:
+    """The question as the model sees it in compact mode: each line prefixed with its 1-based number"""
+    return "\n".join(f"{number}: {line}" for number, line in enumerate(lines, start=1))
+
+
+def longest_compact_answer(line_count: int) -> str:
+    """A compact answer labelling every line, used to bound the completion tokens of a call"""
+    return "\n".join(f"{number}: I1" for number in range(1, line_count + 1))
+
+
+def parse_compact_labels(answer: str, lines) -> dict:
+    """Map line indices (0-based) to the labels of a compact answer
+
+    Pairs whose number is outside the input, or that point at a blank or
+    brace-only line (a miscounted line), are dropped with a warning.
+    """
+    labels = {}
+    invalid = []
+    for answer_line in answer.split("\n"):
+        pair = COMPACT_LINE_PATTERN.match(answer_line)
+        if not pair:
+            continue
+        found = COMPACT_LABEL_PATTERN.findall(pair.group(2))
+        if not found:
+            continue
+        number = int(pair.group(1))
+        if not 1 <= number <= len(lines) or lines[number - 1].strip() in ('', '{', '}'):
+            invalid.append(number)
+            continue
+        labels.setdefault(number - 1, [])
+        for label in found:
+            if label not in labels[number - 1]:
+                labels[number - 1].append(label)
+    if invalid:
+        print(f"Warning: dropped compact labels for invalid line numbers {invalid}")
+    return labels
+
+
+def apply_compact_labels(lines, answer: str) -> str:
+    """Rebuild the labelled function, as the full output mode would return it, from a compact answer"""
+    labels = parse_compact_labels(answer, lines)
+    return "\n".join(
+        line + "".join(f" //{label}" for label in labels.get(index, []))
+        for index, line in enumerate(lines)
+    )
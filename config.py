@@ -0,0 +1,38 @@
+import os
+import sys
+import configparser
+from functools import lru_cache
+
+# Get current directory and config file path
+CUR_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIG = os.path.join(CUR_DIR, "config.ini")
+
+
+@lru_cache(maxsize=None)
+def get_config() -> configparser.ConfigParser:
+    """Parse the config file once per process"""
+    config = configparser.ConfigParser()
+    try:
+        config.read(CONFIG, encoding='utf-8')
+    except UnicodeDecodeError:
+        print(f"Error: Config file encoding issue. Please save config.ini as UTF-8")
+        sys.exit(1)
+    return config
+
+
+def load_config(field: str, value: str, fallback: str = None) -> str:
+    """Load parameters from config file, returning fallback for optional settings"""
+    try:
+        return get_config()[field][value]
+    except KeyError:
+        if fallback is not None:
+            return fallback
+        print(f"Error: Cannot find [{field}] {value} in config file")
+        sys.exit(1)
+
+
+@lru_cache(maxsize=None)
+def set_llm_environment():
+    """Set OpenAI environment variables before the first client is created"""
+    os.environ["OPENAI_API_BASE"] = load_config("LLM", "api_base")
+    os.environ["OPENAI_API_KEY"] = load_config("LLM", "api_key")
@@ -0,0 +1,73 @@
+import re
+from config import load_config
+from token_counter import count_tokens
+
+KB_ENTRY_PATTERN = re.compile(r'^(?P<code>.*?)\s*//\s*(?P<label>I\d)\s*(?P<explanation>.*)$')
+# Decompiler temporaries (v3, a1, ...) and numeric literals do not change which distortion a line shows
+PLACEHOLDER_PATTERN = re.compile(r'\b(?:[av]\d+|0x[0-9a-fA-F]+|\d+)(?:[uU]?[lL]{0,2})\b')
+
+
+def parse_kb_entry(text):
+    """Split a KB line into (code, label, explanation); label and explanation are empty when unlabelled"""
+    entry = KB_ENTRY_PATTERN.match(text.strip())
+    if not entry:
+        return text.strip(), "", ""
+    return entry.group("code"), entry.group("label"), entry.group("explanation").strip()
+
+
+def cluster_key(code, label):
+    """Lines that differ only in variable names, constants and spacing fall into the same cluster"""
+    return label, re.sub(r'\s+', '', PLACEHOLDER_PATTERN.sub('#', code))
+
+
+def rank_hits(hits):
+    """Order (text, score, kb_id) hits best first; hits without a score keep their retrieval order after scored ones"""
+    indexed = list(enumerate(hits))
+    indexed.sort(key=lambda item: (item[1][1] is None, -(item[1][1] or 0.0), item[0]))
+    return [hit for _, hit in indexed]
+
+
+def compress_context(hits, max_tokens=0):
+    """Build the prompt context from retrieved KB lines
+
+    Near-duplicate hits are clustered and only the best scored line of each
+    cluster is kept. A distortion explanation is written once, on the first
+    line of its label that carries it; later lines keep only their //In label.
+    Lines are added best first, skipping any that would take the context
+    over max_tokens (0 for no limit).
+    """
+    seen_clusters = set()
+    seen_explanations = set()
+    lines = []
+    used_tokens = 0
+    for text, score, kb_id in rank_hits(hits):
+        code, label, explanation = parse_kb_entry(text)
+        key = cluster_key(code, label)
+        if key in seen_clusters:
+            continue
+
+        if not label:
+            line = code
+        elif explanation and (label, explanation.lower()) not in seen_explanations:
+            line = f"{code} //{label} {explanation}"
+        else:
+            line = f"{code} //{label}"
+
+        tokens = count_tokens(line + "\n")
+        if max_tokens and used_tokens + tokens > max_tokens:
+            # A shorter line further down may still fit
+            continue
+        used_tokens += tokens
+        seen_clusters.add(key)
+        if label and explanation:
+            seen_explanations.add((label, explanation.lower()))
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def build_context(hits):
+    """Context for one prompt, compressed when [RETRIEVAL] compress_context is on"""
+    if load_config("RETRIEVAL", "compress_context", "false").lower() != "true":
+        # Previous behaviour: exact duplicates removed, hits joined in retrieval order
+        return "\n\n".join(dict.fromkeys(text for text, score, kb_id in hits))
+    return compress_context(hits, int(load_config("RETRIEVAL", "context_max_tokens", "0")))
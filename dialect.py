@@ -0,0 +1,78 @@
+import os
+import re
+import threading
+from config import load_config
+
+# Names and types each decompiler emits and the other does not
+DIALECT_PATTERNS = {
+    "ida": re.compile(
+        r'\b(?:__fastcall|__cdecl|__stdcall|__int64|__int8|_DWORD|_QWORD|_WORD|_BYTE|'
+        r'[LH]O(?:BYTE|WORD|DWORD)|BYTE\d|WORD\d|[av]\d+|LABEL_\d+)\b'
+    ),
+    "ghidra": re.compile(
+        r'\b(?:undefined\d*|param_\d+|[a-z]{1,5}Var\d+|local_[0-9a-f]+|[a-z]*Stack_[0-9a-f]+|'
+        r'(?:LAB|DAT|FUN|PTR|switchD)_[0-9a-f]+\w*|CONCAT\d+|SUB\d+|ZEXT\d+|SEXT\d+)\b'
+    ),
+}
+
+
+def detect_dialect(code: str, default: str = "ida") -> str:
+    """Decompiler that produced a function, by counting dialect-specific names; default when neither shows"""
+    counts = {dialect: len(pattern.findall(code)) for dialect, pattern in DIALECT_PATTERNS.items()}
+    best = max(counts, key=counts.get)
+    if counts[best] == 0 or list(counts.values()).count(counts[best]) > 1:
+        return default
+    return best
+
+
+class DialectRouter:
+    """Retriever and pattern weights of each dialect's knowledge base, loaded once and chosen per function"""
+
+    def __init__(self, knowledge_bases: dict, default: str, loaded: dict = None):
+        from FidelityGPT import init_retriever
+        from pattern_matcher import analyze_fidelity_file
+
+        self.default = default
+        self.indexes = {}
+        by_path = dict(loaded or {})
+        for dialect, knowledge_base_file in knowledge_bases.items():
+            path = os.path.abspath(knowledge_base_file)
+            if path not in by_path:
+                print(f"Loading {dialect} knowledge base {knowledge_base_file}")
+                by_path[path] = (init_retriever(path), analyze_fidelity_file(path))
+            self.indexes[dialect] = by_path[path]
+        self.stats = dict.fromkeys(self.indexes, 0)
+        self.lock = threading.Lock()
+
+    def select(self, code: str) -> tuple:
+        """Return (dialect, retriever, weights) for one function"""
+        dialect = detect_dialect(code, self.default)
+        if dialect not in self.indexes:
+            dialect = self.default
+        with self.lock:
+            self.stats[dialect] += 1
+        retriever, weights = self.indexes[dialect]
+        return dialect, retriever, weights
+
+    def report(self) -> str:
+        return "Dialects: " + ", ".join(f"{dialect} {count} functions" for dialect, count in self.stats.items())
+
+
+def init_router(knowledge_base_file: str, retriever, weights):
+    """Dialect router for this run, or None when [DIALECT] routing is disabled
+
+    The run's own knowledge base is reused for the dialect that names it.
+    """
+    if load_config("DIALECT", "enabled", "false").lower() != "true":
+        return None
+    base_dir = os.path.dirname(os.path.abspath(knowledge_base_file))
+    knowledge_bases = {
+        dialect: os.path.join(base_dir, load_config("DIALECT", dialect))
+        for dialect in DIALECT_PATTERNS
+        if load_config("DIALECT", dialect, "")
+    }
+    return DialectRouter(
+        knowledge_bases,
+        load_config("DIALECT", "default", "ida"),
+        {os.path.abspath(knowledge_base_file): (retriever, weights)},
+    )
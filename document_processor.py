@@ -1,3 +1,14 @@
+import re
+from typing import List
+
+# Functions longer than BLOCK_SIZE lines are detected in overlapping blocks
+BLOCK_SIZE = 50
+BLOCK_OVERLAP = 5
+
+# Written in an answer file in place of a function or block whose detection failed; it carries no label
+FAILED_MARKER = "// FidelityGPT: detection failed"
+
+
 class Document:
     def __init__(self, page_content, metadata=None):
         self.page_content = page_content
@@ -48,6 +59,21 @@ def read_queries(file_path):
         exit()
 
 
+def split_into_blocks(lines: List[str], block_size: int = BLOCK_SIZE, overlap: int = BLOCK_OVERLAP) -> List[List[str]]:
+    """Split long text into blocks with overlap support"""
+    blocks = []
+    total_lines = len(lines)
+
+    start = 0
+    while start < total_lines:
+        end = min(start + block_size, total_lines)
+        block = lines[start:end]
+        blocks.append(block)
+        start += block_size - overlap
+
+    return blocks
+
+
 def write_output(file_path, results):
     try:
         with open(file_path, "w", encoding="utf-8") as f:
@@ -55,3 +81,8 @@ def write_output(file_path, results):
     except Exception as e:
         print(f"Error: {e}")
         exit()
+
+
+def normalize_code_line(line):
+    """Strip distortion labels and whitespace so model output can be compared with input"""
+    return re.sub(r'//\s*I\d.*$', '', line).strip()
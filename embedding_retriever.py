@@ -1,32 +1,160 @@
-from langchain_openai import OpenAIEmbeddings
-from langchain_community.vectorstores import Chroma
-
 import os
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.vectorstores import Chroma
+import hashlib
+import threading
+from config import load_config, set_llm_environment
+from document_processor import Document
+
+EMBEDDING_MODEL = 'text-embedding-ada-002'
 
 def create_embedding(texts):
-    embeddings = OpenAIEmbeddings(model='text-embedding-ada-002')
+    from langchain_openai import OpenAIEmbeddings
+
+    set_llm_environment()
+    embeddings = OpenAIEmbeddings(model=EMBEDDING_MODEL)
     return embeddings
 
 def create_vectorstore(texts, embeddings):
-    db = Chroma.from_texts(texts, embeddings)
+    if load_config("RETRIEVAL", "backend", "chroma") == "numpy":
+        return NumpyVectorStore(texts, embeddings)
+
+    from langchain_community.vectorstores import Chroma
+
+    # The KB line number is kept as the document id, as in the numpy backend
+    db = Chroma.from_texts(texts, embeddings, metadatas=[{"id": index} for index in range(len(texts))])
     return db
 
 def create_retriever(db):
-    retriever = db.as_retriever(search_type="similarity", search_kwargs={"k": 1})
-    return retriever
+    k = int(load_config("RETRIEVAL", "k", "1"))
+    score_threshold = load_config("RETRIEVAL", "score_threshold", "")
+    score_threshold = float(score_threshold) if score_threshold else None
+    if isinstance(db, NumpyVectorStore):
+        return db.as_retriever(search_kwargs={"k": k, "score_threshold": score_threshold})
+    # Keep the score of each Chroma hit, so the context is ranked and capped by similarity as with numpy
+    return ScoredRetriever(db, k, score_threshold)
 
 def retrieve_documents(retriever, sub_queries):
-    retrieved_docs = []
-    for sub_query in sub_queries:
-        sub_query = sub_query.strip()
-        if sub_query:
-            # print(f"Retrieving for sub-query: '{sub_query}'")
-            results = retriever.get_relevant_documents(sub_query)
-            for result in results:
-                if isinstance(result.page_content, str):
-                    retrieved_docs.append(result.page_content)
-                else:
-                    print(f"Non-string result found: {result.page_content}")
-    return retrieved_docs
+    return [text for text, score, kb_id in retrieve_scored_documents(retriever, sub_queries)]
+
+def retrieve_scored_documents(retriever, sub_queries):
+    """Retrieve KB lines for each sub-query as (text, score, KB line id); score is None when the store does not report one"""
+    sub_queries = [sub_query.strip() for sub_query in sub_queries if sub_query.strip()]
+    hits = retrieve_hits_by_query(retriever, sub_queries)
+    return [hit for sub_query in sub_queries for hit in hits[sub_query]]
+
+def retrieve_hits_by_query(retriever, sub_queries):
+    """Retrieve each distinct sub-query once, returning a dict from the stripped sub-query to its (text, score, KB line id) hits"""
+    sub_queries = list(dict.fromkeys(sub_query.strip() for sub_query in sub_queries if sub_query.strip()))
+    if hasattr(retriever, "retrieve_batch"):
+        # One embedding request and one matrix multiply for all sub-queries
+        batch_results = retriever.retrieve_batch(sub_queries)
+    else:
+        batch_results = (retriever.get_relevant_documents(sub_query) for sub_query in sub_queries)
+
+    hits = {}
+    for sub_query, results in zip(sub_queries, batch_results):
+        hits[sub_query] = []
+        for result in results:
+            if isinstance(result.page_content, str):
+                hits[sub_query].append((result.page_content, result.metadata.get("score"), result.metadata.get("id")))
+            else:
+                print(f"Non-string result found: {result.page_content}")
+    return hits
+
+
+class NumpyVectorStore:
+    """In-process vector store: KB embeddings in one contiguous float32 matrix, exact cosine top-k"""
+
+    def __init__(self, texts, embeddings):
+        import numpy as np
+
+        self.texts = list(texts)
+        self.embeddings = embeddings
+        self.matrix = np.ascontiguousarray(normalize_rows(self._embed_knowledge_base()))
+
+    def _embed_knowledge_base(self):
+        """Embed the KB lines, reusing the on-disk cache when the KB has not changed"""
+        import numpy as np
+
+        cache_dir = load_config("RETRIEVAL", "embedding_cache", "")
+        digest = hashlib.sha256("\n".join([EMBEDDING_MODEL] + self.texts).encode("utf-8")).hexdigest()
+        cache_file = os.path.join(cache_dir, f"{digest}.npy") if cache_dir else None
+        if cache_file and os.path.exists(cache_file):
+            return np.load(cache_file)
+
+        matrix = np.asarray(self.embeddings.embed_documents(self.texts), dtype=np.float32)
+        if cache_file:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.save(cache_file, matrix)
+        return matrix
+
+    def search(self, queries, k=1, score_threshold=None):
+        """Return (index, score) pairs of the top-k KB lines for each query, best first"""
+        import numpy as np
+
+        if not queries:
+            return []
+        query_matrix = normalize_rows(np.asarray(self.embeddings.embed_documents(queries), dtype=np.float32))
+        scores = query_matrix @ self.matrix.T
+
+        k = min(k, len(self.texts))
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for row, candidates in enumerate(top):
+            ranked = candidates[np.argsort(-scores[row, candidates])]
+            results.append([
+                (int(index), float(scores[row, index]))
+                for index in ranked
+                if score_threshold is None or scores[row, index] >= score_threshold
+            ])
+        return results
+
+    def as_retriever(self, search_type="similarity", search_kwargs=None):
+        search_kwargs = search_kwargs or {}
+        return NumpyRetriever(self, search_kwargs.get("k", 1), search_kwargs.get("score_threshold"))
+
+
+class NumpyRetriever:
+    """Retriever over a NumpyVectorStore, compatible with get_relevant_documents"""
+
+    def __init__(self, store, k, score_threshold=None):
+        self.store = store
+        self.k = k
+        self.score_threshold = score_threshold
+
+    def retrieve_batch(self, queries):
+        return [
+            [
+                Document(self.store.texts[index], {"id": index, "score": score})
+                for index, score in hits
+            ]
+            for hits in self.store.search(queries, self.k, self.score_threshold)
+        ]
+
+    def get_relevant_documents(self, query):
+        return self.retrieve_batch([query])[0]
+
+
+class ScoredRetriever:
+    """Retriever over a LangChain vector store that reports each hit's relevance score (0 to 1, higher is closer)
+
+    Queries are serialized, as the store is not documented to be safe to share between threads.
+    """
+
+    def __init__(self, db, k, score_threshold=None):
+        self.db = db
+        self.k = k
+        self.score_threshold = score_threshold
+        self.lock = threading.Lock()
+
+    def get_relevant_documents(self, query):
+        search_kwargs = {"score_threshold": self.score_threshold} if self.score_threshold is not None else {}
+        with self.lock:
+            results = self.db.similarity_search_with_relevance_scores(query, k=self.k, **search_kwargs)
+        return [Document(doc.page_content, dict(doc.metadata, score=score)) for doc, score in results]
+
+
+def normalize_rows(matrix):
+    import numpy as np
+
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
@@ -0,0 +1,96 @@
+import sys
+import tracemalloc
+from contextlib import contextmanager
+
+TOP_SITES = 5
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, or None where the resource module is unavailable"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+class MemoryProfiler:
+    """tracemalloc snapshots around pipeline stages; stages are no-ops until start() is called
+
+    Repeated stages (one per function) are aggregated: calls, net growth,
+    the highest traced peak, and the allocation sites that grew the most.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.stages = {}
+
+    def start(self):
+        tracemalloc.start()
+        self.enabled = True
+
+    @staticmethod
+    def _snapshot():
+        # Leave out the profiler's own bookkeeping
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ])
+
+    @contextmanager
+    def stage(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        before = self._snapshot()
+        tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            after = self._snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            entry = self.stages.setdefault(name, {"calls": 0, "net_bytes": 0, "peak_bytes": 0, "sites": {}})
+            entry["calls"] += 1
+            entry["peak_bytes"] = max(entry["peak_bytes"], peak)
+            for stat in after.compare_to(before, "lineno"):
+                entry["net_bytes"] += stat.size_diff
+                if stat.size_diff > 0:
+                    site = str(stat.traceback[0])
+                    entry["sites"][site] = entry["sites"].get(site, 0) + stat.size_diff
+
+    def to_dict(self) -> dict:
+        return {
+            "peak_rss_mb": peak_rss_mb(),
+            "stages": {
+                name: {
+                    "calls": entry["calls"],
+                    "net_mb": round(entry["net_bytes"] / 2 ** 20, 3),
+                    "peak_traced_mb": round(entry["peak_bytes"] / 2 ** 20, 3),
+                    "top_sites": [
+                        {"site": site, "mb": round(size / 2 ** 20, 3)}
+                        for site, size in sorted(entry["sites"].items(), key=lambda item: -item[1])[:TOP_SITES]
+                    ],
+                }
+                for name, entry in self.stages.items()
+            },
+        }
+
+    def report(self) -> str:
+        profile = self.to_dict()
+        lines = ["Memory profile:"]
+        for name, stage in profile["stages"].items():
+            lines.append(
+                f"  {name}: {stage['calls']} calls, net {stage['net_mb']:+.3f} MB, "
+                f"peak traced {stage['peak_traced_mb']:.3f} MB"
+            )
+            for site in stage["top_sites"]:
+                lines.append(f"    {site['mb']:>8.3f} MB  {site['site']}")
+        if profile["peak_rss_mb"] is not None:
+            lines.append(f"  Peak RSS: {profile['peak_rss_mb']:.1f} MB")
+        return "\n".join(lines)
+
+
+# Shared by all stages of one run
+PROFILER = MemoryProfiler()
@@ -1,5 +1,6 @@
 import re
 import random
+from config import load_config
 
 
 def analyze_fidelity_file(file_path):
@@ -129,26 +130,38 @@ def calculate_max_semantic_strength(line, weights):
     return max(strengths, key=lambda x: x[1]) if strengths else (None, 0)
 
 
-def match_patterns(query_lines, fidelity_file_path='fidelity_new.c'):
+def is_relevant_line(line):
+    """Lines that take part in matching: not blank and not a lone brace"""
+    return bool(line.strip()) and line.strip() not in ['{', '}']
+
+
+def match_patterns(query_lines, fidelity_file_path=None, weights=None):
     """
-    According to the dynamic weight matching mode
+    According to the dynamic weight matching mode.
+    Pass precomputed weights to avoid re-analyzing the knowledge base on every call.
     """
     # Analyze the fidelity_new. c file to obtain weights
-    weights = analyze_fidelity_file(fidelity_file_path)
+    if weights is None:
+        weights = analyze_fidelity_file(fidelity_file_path or load_config("PATHS", "knowledge_base", "fidelity_new.c"))
 
 
-    relevant_lines = [line for line in query_lines[1:] if line.strip() and line.strip() not in ['{', '}']]
+    relevant_lines = [line for line in query_lines[1:] if is_relevant_line(line)]
 
 
     line_strengths = [(line, *calculate_max_semantic_strength(line, weights)) for line in relevant_lines]
 
+    return select_lines(line_strengths)
 
 
-
-    line_strengths.sort(key=lambda x: x[2], reverse=True)
+def select_lines(line_strengths):
+    """
+    Select the lines to retrieve for from (line, type, strength) triples of the relevant lines.
+    Scores can be computed once per function and sliced per block.
+    """
+    line_strengths = sorted(line_strengths, key=lambda x: x[2], reverse=True)
 
 
-    total_lines = len(relevant_lines)
+    total_lines = len(line_strengths)
     if total_lines <= 5:
         output_lines = total_lines
     else:
@@ -197,7 +210,7 @@ def select_random_lines(query_lines):
     Randomly select 6 lines from the code as the reference group.
     """
 
-    relevant_lines = [line for line in query_lines[1:] if line.strip() and line.strip() not in ['{', '}']]
+    relevant_lines = [line for line in query_lines[1:] if is_relevant_line(line)]
 
 
     if len(relevant_lines) < 6:
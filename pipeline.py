@@ -0,0 +1,165 @@
+import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from document_processor import read_queries, split_into_blocks, write_output
+from pattern_matcher import analyze_fidelity_file
+from prompt_templates import create_RAG_correction_template
+from config import load_config
+from FidelityGPT import (
+    detect_query,
+    merge_blocks,
+    init_retriever,
+    init_llm,
+)
+from Correction import correct_query
+from rate_limiter import CircuitOpenError, get_rate_limiter
+from token_counter import BudgetExceededError, get_ledger, write_run_report
+from triage import init_triage
+from dialect import init_router
+
+
+class Pipeline:
+    """Detection and correction sharing one knowledge base index, weights and LLM client
+
+    The server calls detect and correct from several threads at once. Shared
+    state is either read-only after construction (weights, numpy index,
+    templates) or guarded: the ledger keeps its context per thread, and the
+    rate limiter, triage, router, Chroma retriever and retrieval log lock.
+    """
+
+    def __init__(self, knowledge_base_file: str, output_dir: str = ""):
+        self.weights = analyze_fidelity_file(knowledge_base_file)
+        self.retriever = init_retriever(knowledge_base_file)
+        self.llm, self.RAG_prompt, self.RAG_prompt_with_variable = init_llm()
+        self.rag_correction_template = create_RAG_correction_template()
+        self.triage = init_triage(knowledge_base_file, self.weights, output_dir) if output_dir else None
+        self.router = init_router(knowledge_base_file, self.retriever, self.weights)
+
+    def detect(self, query_index: int, query: str, file_name: str = "") -> str:
+        """Detect distortions in one function and merge its blocks into a single labelled function"""
+        get_ledger().set_context(file_name, f"Query {query_index + 1}")
+        run_detection = lambda model: detect_query(
+            query_index,
+            query,
+            self.retriever,
+            model,
+            self.RAG_prompt,
+            self.RAG_prompt_with_variable,
+            self.weights,
+            router=self.router,
+        )
+        if self.triage is None:
+            detections = run_detection(self.llm)
+        else:
+            detections, _ = self.triage.run(file_name, query_index, query, self.llm, run_detection)
+
+        # Functions of 50 lines or fewer come back as one unblocked result
+        if detections and detections[0][0] is None:
+            RAG_result = detections[0][1]
+            return RAG_result if RAG_result is not None else query.strip()
+
+        # Keep the unlabelled input for blocks whose detection failed so the function stays complete
+        blocks = split_into_blocks(query.strip().split("\n"))
+        block_results = [
+            RAG_result if RAG_result is not None else "\n".join(blocks[block_index])
+            for block_index, RAG_result in detections
+        ]
+        return merge_blocks(block_results, blocks)
+
+    def correct(self, detected: str, file_name: str = "", query_index: int = 0) -> str:
+        """Correct one labelled function"""
+        get_ledger().set_context(file_name, f"Query {query_index + 1}")
+        return correct_query(detected, self.llm, self.rag_correction_template)
+
+
+def process_file(file_path: str, output_dir: str, pipeline: Pipeline):
+    """Detect and correct every function in the file, overlapping correction of one function with detection of the next"""
+    try:
+        queries = read_queries(file_path)
+    except Exception:
+        return
+
+    base_filename = os.path.basename(file_path).split('.')[0]
+    detections = []
+    corrections = []
+    budget_error = None
+    # Set by a correction that ran out of budget or hit an open breaker; detection stops there too
+    correction_stops = []
+
+    def stop_on(future):
+        if not future.cancelled() and isinstance(future.exception(), (BudgetExceededError, CircuitOpenError)):
+            correction_stops.append(future.exception())
+
+    # A single correction worker runs behind detection, so results stay in order
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        for query_index, query in enumerate(queries):
+            if correction_stops:
+                break
+            try:
+                detected = pipeline.detect(query_index, query, base_filename)
+            except (BudgetExceededError, CircuitOpenError) as e:
+                budget_error = e
+                break
+            detections.append(detected)
+            corrections.append(executor.submit(pipeline.correct, detected, base_filename, query_index))
+            corrections[-1].add_done_callback(stop_on)
+
+        correction_results = []
+        for query_index, future in enumerate(corrections):
+            try:
+                correction_results.append(f"Query {query_index + 1}:\n{future.result()}\n")
+            except (BudgetExceededError, CircuitOpenError) as e:
+                # The corrections queued behind it would fail the same way
+                for pending in corrections[query_index + 1:]:
+                    pending.cancel()
+                budget_error = budget_error or e
+                break
+            except Exception as e:
+                print(f"Error correcting query {query_index + 1}: {e}")
+
+    write_output(os.path.join(output_dir, f"{base_filename}_RAG_answer.txt"), "\n/////\n".join(detections))
+    write_output(os.path.join(output_dir, f"{base_filename}_RAG_Correct.txt"), "\n/////\n".join(correction_results))
+
+    if budget_error is not None:
+        raise budget_error
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Detect and correct decompilation distortions in one pass.")
+    parser.add_argument('--input_dir', type=str, default=None, help="Input directory, defaults to [PATHS] input_dir.")
+    parser.add_argument('--output_dir', type=str, default=None, help="Output directory, defaults to [PATHS] output_dir.")
+    args = parser.parse_args()
+
+    current_dir = os.getcwd()
+    testdata_dir = os.path.join(current_dir, args.input_dir or load_config("PATHS", "input_dir"))
+    output_dir = os.path.join(current_dir, args.output_dir or load_config("PATHS", "output_dir"))
+    knowledge_base_file = os.path.join(current_dir, load_config("PATHS", "knowledge_base"))
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    pipeline = Pipeline(knowledge_base_file, output_dir)
+
+    try:
+        for root, dirs, files in os.walk(testdata_dir):
+            for file in files:
+                file_path = os.path.join(root, file)
+                print(f"Processing file: {file_path}")
+                process_file(file_path, output_dir, pipeline)
+    except (BudgetExceededError, CircuitOpenError) as e:
+        print(f"Stopping: {e}")
+
+    print(get_rate_limiter().report())
+    print(get_ledger().report())
+    report = {"tokens": get_ledger().to_dict(), "rate_limit": get_rate_limiter().to_dict()}
+    if pipeline.triage is not None:
+        print(pipeline.triage.report())
+        report["triage"] = pipeline.triage.stats
+    if pipeline.router is not None:
+        print(pipeline.router.report())
+        report["dialects"] = pipeline.router.stats
+    write_run_report(output_dir, report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import queue
+import threading
+
+_END = object()
+
+
+class Prefetcher:
+    """Iterate over items produced ahead of time by a background thread
+
+    The producer runs at most `size` items ahead of the consumer; a full queue
+    blocks it, so memory stays flat however long the input is. An exception in
+    the producer is raised in the consumer when it reaches that point.
+    """
+
+    def __init__(self, items, size: int):
+        self.queue = queue.Queue(maxsize=size)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._produce, args=(items,), daemon=True)
+        self.thread.start()
+
+    def _produce(self, items):
+        try:
+            for item in items:
+                if not self._put((item, None)):
+                    return
+        except Exception as e:
+            self._put((None, e))
+            return
+        finally:
+            if hasattr(items, "close"):
+                items.close()
+        self._put((_END, None))
+
+    def _put(self, entry) -> bool:
+        """Wait for room in the queue, giving up once the consumer has stopped"""
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        while True:
+            item, error = self.queue.get()
+            if error is not None:
+                raise error
+            if item is _END:
+                return
+            yield item
+
+    def close(self):
+        """Stop the producer and wait for it to finish its current item"""
+        self.stopped.set()
+        self.thread.join()
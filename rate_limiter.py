@@ -0,0 +1,424 @@
+import time
+import threading
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import lru_cache
+from config import load_config
+from token_counter import BudgetExceededError, count_tokens, get_ledger
+
+
+class CircuitOpenError(Exception):
+    """Raised when the endpoint keeps failing after the circuit breaker's pauses"""
+
+
+class TokenBucket:
+    """Bucket refilled continuously at capacity per minute"""
+
+    def __init__(self, capacity_per_minute: float):
+        self.capacity = capacity_per_minute
+        self.rate = capacity_per_minute / 60
+        self.tokens = capacity_per_minute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount: float):
+        """Block until amount can be taken from the bucket"""
+        # A single request larger than the bucket waits for a full bucket instead of forever
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class LatencyHistogram:
+    """Latencies of completed calls: log-spaced buckets for the run report, recent samples for percentiles"""
+
+    BOUNDS_MS = (250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000)
+
+    def __init__(self, recent: int = 1000):
+        self.counts = [0] * (len(self.BOUNDS_MS) + 1)
+        self.recent = deque(maxlen=recent)
+        self.total_ms = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, seconds: float):
+        latency_ms = seconds * 1000
+        with self.lock:
+            self.counts[bisect_left(self.BOUNDS_MS, latency_ms)] += 1
+            self.recent.append(latency_ms)
+            self.total_ms += latency_ms
+
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def percentile(self, p: float):
+        """Latency in ms below which p percent of the recent calls completed, None before any call"""
+        with self.lock:
+            ordered = sorted(self.recent)
+        if not ordered:
+            return None
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    def to_dict(self) -> dict:
+        count = self.count()
+        labels = [f"<={bound}ms" for bound in self.BOUNDS_MS] + [f">{self.BOUNDS_MS[-1]}ms"]
+        return {
+            "count": count,
+            "mean_ms": round(self.total_ms / count, 1) if count else None,
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "p99_ms": self.percentile(99),
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+class CircuitBreaker:
+    """Pause LLM calls when the recent error rate spikes, instead of failing through the corpus
+
+    When error_rate of the last window calls failed, calls wait cooldown
+    seconds; then a single trial call is let through while the others keep
+    waiting for its outcome, and a failed trial pauses again. After
+    max_trips pauses without a successful call in between, CircuitOpenError
+    stops the run.
+    """
+
+    def __init__(self, error_rate: float, window: int, cooldown: float, max_trips: int):
+        self.error_rate = error_rate
+        self.outcomes = deque(maxlen=window)
+        self.cooldown = cooldown
+        self.max_trips = max_trips
+        self.state = "closed"
+        self.open_until = 0.0
+        self.probing = False
+        self.trips = 0
+        self.consecutive_trips = 0
+        self.condition = threading.Condition()
+
+    def before_call(self) -> bool:
+        """Wait out an open breaker, returning True for the trial call; raise CircuitOpenError once it has tripped too often"""
+        with self.condition:
+            while True:
+                if self.consecutive_trips > self.max_trips:
+                    raise CircuitOpenError(
+                        f"LLM endpoint still failing after {self.max_trips} pauses of {self.cooldown:g}s"
+                    )
+                if self.state == "closed":
+                    return False
+                wait_seconds = self.open_until - time.monotonic()
+                if self.state == "open" and wait_seconds <= 0:
+                    self.state = "half_open"
+                if self.state == "half_open":
+                    if not self.probing:
+                        self.probing = True
+                        return True
+                    # Only the trial call goes out until it succeeds or opens the breaker again
+                    self.condition.wait()
+                else:
+                    self.condition.wait(wait_seconds)
+
+    def end_trial(self):
+        """Let another call be the trial after a trial that says nothing about the endpoint (throttled)"""
+        with self.condition:
+            self.probing = False
+            self.condition.notify_all()
+
+    def record(self, success: bool, trial: bool = False):
+        with self.condition:
+            if trial:
+                self.probing = False
+            self.condition.notify_all()
+            if success:
+                self.outcomes.append(True)
+                self.state = "closed"
+                self.consecutive_trips = 0
+                return
+            self.outcomes.append(False)
+            if self.state == "open":
+                return
+            if self.state == "half_open":
+                if not trial:
+                    # A call sent before the pause; the trial decides
+                    return
+                reason = "trial call after the pause failed"
+            else:
+                failures = self.outcomes.count(False)
+                if len(self.outcomes) < self.outcomes.maxlen or failures < self.error_rate * len(self.outcomes):
+                    return
+                reason = f"{failures} of the last {len(self.outcomes)} LLM calls failed"
+            self.state = "open"
+            self.trips += 1
+            self.consecutive_trips += 1
+            self.open_until = time.monotonic() + self.cooldown
+            self.outcomes.clear()
+            stopping = self.consecutive_trips > self.max_trips
+        if stopping:
+            print(f"Circuit breaker open: {reason}, stopping")
+        else:
+            print(
+                f"Circuit breaker open: {reason}, pausing LLM calls for {self.cooldown:g}s "
+                f"(pause {self.consecutive_trips}/{self.max_trips})"
+            )
+
+
+class AdaptiveRateLimiter:
+    """Client-side RPM/TPM limiter whose concurrency adapts to throttling (AIMD)
+
+    Concurrency grows by one slot per window of successful calls and is halved
+    whenever the provider answers with a rate limit or timeout.
+    """
+
+    def __init__(
+            self,
+            requests_per_minute: float,
+            tokens_per_minute: float,
+            max_concurrency: int,
+            max_retries: int,
+            retry_backoff: float,
+            hedge_percentile: float = 0,
+            hedge_min_samples: int = 20,
+            breaker: CircuitBreaker = None,
+    ):
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker = breaker
+        self.latency = LatencyHistogram()
+        self.stats = {"requests": 0, "retries": 0, "throttled": 0, "failures": 0, "hedged": 0, "hedge_wins": 0}
+
+    def share(self, workers: int):
+        """Keep this process to 1/workers of the configured request rate, token rate and concurrency"""
+        for bucket in (self.request_bucket, self.token_bucket):
+            bucket.capacity /= workers
+            bucket.rate /= workers
+            bucket.tokens = min(bucket.tokens, bucket.capacity)
+        with self.condition:
+            self.max_concurrency = max(1, self.max_concurrency // workers)
+            self.concurrency = min(self.concurrency, float(self.max_concurrency))
+
+    def acquire(self, tokens: int):
+        """Wait for a concurrency slot and for request and token budget"""
+        with self.condition:
+            while self.in_flight >= int(self.concurrency):
+                self.condition.wait()
+            self.in_flight += 1
+        self.request_bucket.consume(1)
+        self.token_bucket.consume(tokens)
+
+    def release(self, throttled: bool = False):
+        """Free a slot and adapt concurrency to the outcome of the call"""
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.concurrency = max(1.0, self.concurrency / 2)
+            else:
+                self.concurrency = min(float(self.max_concurrency), self.concurrency + 1 / self.concurrency)
+            self.condition.notify_all()
+
+    def acquire_hedge(self, tokens: int) -> bool:
+        """Take a concurrency slot, budget and rate for a duplicate request if a slot is free right now"""
+        with self.condition:
+            if self.in_flight >= int(self.concurrency):
+                return False
+            self.in_flight += 1
+        try:
+            get_ledger().check(tokens)
+        except BudgetExceededError:
+            self.free_slot()
+            return False
+        self.request_bucket.consume(1)
+        self.token_bucket.consume(tokens)
+        return True
+
+    def free_slot(self):
+        """Free a slot without adapting concurrency"""
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def hedge_delay(self):
+        """Seconds after which a duplicate request is sent, or None while hedging is off or latencies are unknown"""
+        if not self.hedge_percentile or self.latency.count() < self.hedge_min_samples:
+            return None
+        return self.latency.percentile(self.hedge_percentile) / 1000
+
+    def run_hedged(self, func, tokens: int, prompt_tokens: int):
+        """Run func, sending a duplicate once it is slower than the hedge percentile; the first answer wins
+
+        No duplicate is sent when every concurrency slot is taken or the token
+        budget cannot cover it. The duplicate's slot is held until both
+        requests have finished, as the loser keeps running after the winner
+        returns. The loser is charged to the ledger under the "hedge" stage
+        when it finishes: prompt_tokens and the tokens of its discarded answer.
+        """
+        delay = self.hedge_delay()
+        if delay is None:
+            return func()
+        executor = ThreadPoolExecutor(max_workers=2)
+        try:
+            futures = [executor.submit(func)]
+            pending = set(futures)
+            done, pending = wait(pending, timeout=delay)
+            hedge = None
+            if not done and self.acquire_hedge(tokens):
+                with self.condition:
+                    self.stats["hedged"] += 1
+                futures.append(executor.submit(func))
+                pending.add(futures[1])
+                # Whichever comes last, the loser finishing or the winner being picked, charges the loser
+                hedge = {"running": 2, "winner": None, "context": get_ledger().context()}
+
+                def finished(future):
+                    with self.condition:
+                        hedge["running"] -= 1
+                        last = hedge["running"] == 0
+                        charge = last and hedge["winner"] is not None
+                    if last:
+                        self.free_slot()
+                    if charge:
+                        self.charge_loser(futures, hedge, prompt_tokens)
+
+                for future in futures:
+                    future.add_done_callback(finished)
+            while True:
+                for future in futures:
+                    if future in done and future.exception() is None:
+                        if hedge is not None:
+                            with self.condition:
+                                hedge["winner"] = future
+                                charge = hedge["running"] == 0
+                                if future is not futures[0]:
+                                    self.stats["hedge_wins"] += 1
+                            if charge:
+                                self.charge_loser(futures, hedge, prompt_tokens)
+                        return future.result()
+                if not pending:
+                    # Both requests failed
+                    return futures[0].result()
+                newly_done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                done |= newly_done
+        finally:
+            # A blocking HTTP call cannot be interrupted: the losing request is abandoned and its answer discarded
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def charge_loser(futures, hedge: dict, prompt_tokens: int):
+        """Charge the finished losing request of a hedged call to the ledger"""
+        loser = futures[1] if hedge["winner"] is futures[0] else futures[0]
+        completion_tokens = 0
+        if loser.exception() is None:
+            result = loser.result()
+            completion_tokens = count_tokens(getattr(result, "content", result))
+        get_ledger().charge("hedge", prompt_tokens, completion_tokens, context=hedge["context"])
+
+    def call(self, func, tokens: int, hedge: bool = True, prompt_tokens: int = None):
+        """Run func under the limiter, retrying throttled and failed calls before giving up
+
+        tokens is the call's estimate (prompt and expected answer), used for
+        the TPM budget; prompt_tokens, defaulting to tokens, is what a losing
+        hedged duplicate is charged for its prompt. With hedge, a call slower
+        than the configured percentile of recent latencies gets a duplicate
+        request; pass hedge=False for calls with side effects, such as
+        streaming into a file. The breaker's trial call is never hedged.
+        """
+        if prompt_tokens is None:
+            prompt_tokens = tokens
+        attempt = 0
+        while True:
+            trial = self.breaker.before_call() if self.breaker is not None else False
+            self.acquire(tokens)
+            with self.condition:
+                self.stats["requests"] += 1
+            started = time.perf_counter()
+            try:
+                result = self.run_hedged(func, tokens, prompt_tokens) if hedge and not trial else func()
+            except Exception as e:
+                throttled = is_throttling_error(e)
+                self.release(throttled=throttled)
+                if self.breaker is not None:
+                    if throttled:
+                        # Throttling is handled by lowering concurrency, not by the breaker
+                        if trial:
+                            self.breaker.end_trial()
+                    else:
+                        self.breaker.record(False, trial)
+                with self.condition:
+                    if throttled:
+                        self.stats["throttled"] += 1
+                    if attempt >= self.max_retries:
+                        self.stats["failures"] += 1
+                        raise
+                    self.stats["retries"] += 1
+                attempt += 1
+                print(f"LLM call failed ({type(e).__name__}: {e}), retry {attempt}/{self.max_retries}")
+                time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+                continue
+            self.latency.record(time.perf_counter() - started)
+            if self.breaker is not None:
+                self.breaker.record(True, trial)
+            self.release()
+            return result
+
+    def to_dict(self) -> dict:
+        """Call statistics and the latency histogram for the run report"""
+        report = dict(self.stats)
+        report["latency"] = self.latency.to_dict()
+        if self.breaker is not None:
+            report["breaker_trips"] = self.breaker.trips
+        return report
+
+    def report(self) -> str:
+        return (
+            f"LLM calls: {self.stats['requests']}, retries: {self.stats['retries']}, "
+            f"throttled: {self.stats['throttled']}, failures: {self.stats['failures']}, "
+            f"concurrency: {int(self.concurrency)}/{self.max_concurrency}, "
+            f"hedged: {self.stats['hedged']} ({self.stats['hedge_wins']} won), "
+            f"latency p50/p95/p99: {format_ms(self.latency.percentile(50))}/"
+            f"{format_ms(self.latency.percentile(95))}/{format_ms(self.latency.percentile(99))}"
+        )
+
+
+def format_ms(latency_ms) -> str:
+    return "-" if latency_ms is None else f"{latency_ms:.0f}ms"
+
+
+def is_throttling_error(error: Exception) -> bool:
+    """Rate limit (HTTP 429) and timeout errors, detected without importing the client library"""
+    if getattr(error, "status_code", None) == 429:
+        return True
+    name = type(error).__name__
+    return "RateLimit" in name or "Timeout" in name or isinstance(error, TimeoutError)
+
+
+@lru_cache(maxsize=None)
+def get_rate_limiter() -> AdaptiveRateLimiter:
+    """Process-wide limiter shared by detection, variable analysis and correction"""
+    return AdaptiveRateLimiter(
+        requests_per_minute=float(load_config("RATE_LIMIT", "requests_per_minute", "500")),
+        tokens_per_minute=float(load_config("RATE_LIMIT", "tokens_per_minute", "30000")),
+        max_concurrency=int(load_config("RATE_LIMIT", "max_concurrency", "8")),
+        max_retries=int(load_config("RATE_LIMIT", "max_retries", "5")),
+        retry_backoff=float(load_config("RATE_LIMIT", "retry_backoff", "2")),
+        hedge_percentile=float(load_config("RATE_LIMIT", "hedge_percentile", "0")),
+        hedge_min_samples=int(load_config("RATE_LIMIT", "hedge_min_samples", "20")),
+        breaker=CircuitBreaker(
+            error_rate=float(load_config("RATE_LIMIT", "breaker_error_rate", "0.5")),
+            window=int(load_config("RATE_LIMIT", "breaker_window", "20")),
+            cooldown=float(load_config("RATE_LIMIT", "breaker_cooldown", "60")),
+            max_trips=int(load_config("RATE_LIMIT", "breaker_max_trips", "3")),
+        ),
+    )
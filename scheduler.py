@@ -0,0 +1,74 @@
+import time
+from config import load_config
+from document_processor import BLOCK_SIZE, split_into_blocks
+from token_counter import count_tokens
+
+# Tokens each detection call carries besides the code: prompt template and retrieved context
+CALL_OVERHEAD_TOKENS = 1500
+
+
+def estimate_cost(query: str) -> int:
+    """Estimated work of one function's detection, in tokens sent and received
+
+    Functions over BLOCK_SIZE lines take one call per overlapping block and
+    run the variable stage first, which is a call of its own in the LLM
+    [VARIABLES] modes. A full answer repeats the block with labels; a compact
+    answer is a few tokens per line.
+    """
+    lines = query.strip().split("\n")
+    blocks = split_into_blocks(lines) if len(lines) > BLOCK_SIZE else [lines]
+    compact = load_config("LLM", "compact_output", "false").lower() == "true"
+    cost = 0
+    for block in blocks:
+        tokens = count_tokens("\n".join(block))
+        cost += CALL_OVERHEAD_TOKENS + tokens + (len(block) if compact else tokens)
+    if len(lines) > BLOCK_SIZE and load_config("VARIABLES", "mode", "local") != "local":
+        cost += CALL_OVERHEAD_TOKENS + 2 * count_tokens(query)
+    return cost
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class ProgressReporter:
+    """Progress, throughput and ETA of a queue run
+
+    Work already finished when the run starts (a resumed queue) counts
+    towards progress but not towards throughput. The ETA divides the
+    estimated cost still pending by the cost finished per second so far,
+    so a few long functions left at the end are not mistaken for little work.
+    """
+
+    def __init__(self, progress: dict):
+        self.started = time.perf_counter()
+        self.start_finished = progress["finished"]
+        self.start_finished_cost = progress["finished_cost"]
+
+    def line(self, progress: dict) -> str:
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        finished = progress["finished"] - self.start_finished
+        # Queue files without cost estimates measure work in functions
+        if progress["cost"]:
+            total, done, start_done = progress["cost"], progress["finished_cost"], self.start_finished_cost
+        else:
+            total, done, start_done = progress["tasks"], progress["finished"], self.start_finished
+        rate = (done - start_done) / elapsed
+        if done >= total:
+            eta = "done"
+        elif rate > 0:
+            eta = format_duration((total - done) / rate)
+        else:
+            eta = "unknown"
+        line = (
+            f"Progress: {progress['finished']}/{progress['tasks']} functions, "
+            f"{done / total if total else 1.0:.0%} of estimated work, {finished / elapsed:.2f} functions/s"
+        )
+        if progress["cost"]:
+            line += f", {rate:.0f} est. tokens/s"
+        return line + f", ETA {eta}"
@@ -0,0 +1,167 @@
+import os
+import json
+import queue
+import argparse
+import itertools
+import threading
+import socketserver
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from document_processor import read_queries
+from config import load_config
+from pipeline import Pipeline
+
+
+class BatchQueue:
+    """Request queue that hands each function to the warm pipeline as soon as one of batch_size workers is free
+
+    Functions are started in arrival order and each finishes on its own, so a
+    slow function holds only its own worker, not the requests behind it.
+    """
+
+    def __init__(self, pipeline: Pipeline, batch_size: int):
+        self.pipeline = pipeline
+        self.batch_size = batch_size
+        self.requests = queue.Queue()
+        self.slots = threading.Semaphore(batch_size)
+        self.executor = ThreadPoolExecutor(max_workers=batch_size)
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, task: str, query: str, query_index: int, file_name: str) -> Future:
+        """Queue one function of a request for "detect", "correct" or "pipeline" and return its future"""
+        future = Future()
+        self.requests.put((task, query, query_index, file_name, future))
+        return future
+
+    def _run(self):
+        while True:
+            request = self.requests.get()
+            # Requests wait here, visible in the queued count, until a worker is free
+            self.slots.acquire()
+            future = request[4]
+            self.executor.submit(self._process, *request[:4]).add_done_callback(
+                lambda result, future=future: self._finish(future, result)
+            )
+
+    def _finish(self, future: Future, result: Future):
+        self.slots.release()
+        try:
+            future.set_result(result.result())
+        except Exception as e:
+            future.set_exception(e)
+
+    def _process(self, task: str, query: str, query_index: int, file_name: str) -> dict:
+        result = {}
+        if task in ("detect", "pipeline"):
+            result["detection"] = self.pipeline.detect(query_index, query, file_name)
+            query = result["detection"]
+        if task in ("correct", "pipeline"):
+            result["correction"] = self.pipeline.correct(query, file_name, query_index)
+        return result
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """JSON API: POST /detect, /correct or /pipeline with "functions", "code" or "file"; GET /health"""
+
+    batch_queue = None
+    request_counter = itertools.count(1)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok", "queued": self.batch_queue.requests.qsize()})
+        else:
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        task = self.path.strip("/")
+        if task not in ("detect", "correct", "pipeline"):
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            queries = self._read_functions(body)
+        except (ValueError, OSError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+
+        # Functions are numbered within the request; token usage and triage logs are attributed to it
+        file_name = os.path.basename(body["file"]).split('.')[0] if "file" in body else f"request-{next(self.request_counter)}"
+        futures = [
+            self.batch_queue.submit(task, query, query_index, file_name) for query_index, query in enumerate(queries)
+        ]
+        # A failed function gets an error entry; the others keep their results
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append({"error": str(e)})
+        self._send_json(200, {"results": results})
+
+    def _read_functions(self, body: dict) -> list:
+        """Collect the functions of a request, split on ///// like the input files"""
+        if "functions" in body:
+            return [query.strip() for query in body["functions"] if query.strip()]
+        if "code" in body:
+            return [query.strip() for query in body["code"].split("/////") if query.strip()]
+        if "file" in body:
+            if not os.path.isfile(body["file"]):
+                raise ValueError(f"The file '{body['file']}' was not found.")
+            return read_queries(body["file"])
+        raise ValueError('Request needs one of "functions", "code" or "file"')
+
+    def _send_json(self, status: int, payload: dict):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket clients have no host/port pair
+        return self.client_address[0] if self.client_address else "unix"
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve detection and correction from a warm process.")
+    parser.add_argument('--host', type=str, default=load_config("SERVER", "host"), help="Address to listen on.")
+    parser.add_argument('--port', type=int, default=int(load_config("SERVER", "port")), help="Port to listen on.")
+    parser.add_argument('--socket', type=str, default=None, help="Listen on this Unix socket instead of TCP.")
+    args = parser.parse_args()
+
+    knowledge_base_file = os.path.join(os.getcwd(), load_config("PATHS", "knowledge_base"))
+    # Triage logs its routing decisions to the output folder, as in batch runs
+    output_dir = os.path.join(os.getcwd(), load_config("PATHS", "output_dir"))
+    os.makedirs(output_dir, exist_ok=True)
+    RequestHandler.batch_queue = BatchQueue(
+        Pipeline(knowledge_base_file, output_dir),
+        int(load_config("SERVER", "batch_size")),
+    )
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixHTTPServer(args.socket, RequestHandler)
+        print(f"Listening on unix socket {args.socket}")
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+        print(f"Listening on http://{args.host}:{args.port}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import re
+from document_processor import normalize_code_line
+
+LABEL_PATTERN = re.compile(r'//\s*(I\d)')
+STRING_OR_COMMENT_PATTERN = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|//.*$|/\*.*?\*/')
+
+# How far ahead in the input a streamed line may match, to tolerate lines the model drops
+MATCH_WINDOW = 5
+
+
+def parse_labels(line):
+    """Return the distortion labels (I1-I6) appended to a line"""
+    return LABEL_PATTERN.findall(line)
+
+
+def brace_delta(line):
+    """Net brace depth change of a line, ignoring braces in strings and comments"""
+    code = STRING_OR_COMMENT_PATTERN.sub('', line)
+    return code.count('{') - code.count('}')
+
+
+def closes_only_at_end(lines):
+    """Whether the brace depth of a function returns to zero only on its last code line"""
+    depth = 0
+    opened = False
+    code_lines = [line for line in lines if line.strip()]
+    for index, line in enumerate(code_lines):
+        depth += brace_delta(line)
+        opened = opened or depth > 0
+        if opened and depth == 0:
+            return index == len(code_lines) - 1
+    return False
+
+
+class LabelledLineParser:
+    """Incrementally split a streamed completion into code lines and their //In labels
+
+    The parser marks itself finished once every input line has been echoed, or,
+    for a complete function, once its closing brace has been emitted. Anything
+    the model writes after that point is runaway output.
+    """
+
+    def __init__(self, input_lines):
+        self.expected = [normalize_code_line(line) for line in input_lines if normalize_code_line(line)]
+        self.track_braces = closes_only_at_end(input_lines)
+        self.matched = 0
+        self.depth = 0
+        self.opened = False
+        self.buffer = ""
+        self.pending_blank = 0
+        self.lines = []
+        self.labels = []
+        self.finished = False
+
+    def feed(self, chunk):
+        """Consume a chunk of text and return the lines it completed"""
+        self.buffer += chunk
+        completed = []
+        while "\n" in self.buffer and not self.finished:
+            line, self.buffer = self.buffer.split("\n", 1)
+            completed.extend(self._accept(line))
+        return completed
+
+    def close(self):
+        """Flush the trailing partial line at the end of the stream"""
+        line, self.buffer = self.buffer, ""
+        if self.finished:
+            return []
+        return self._accept(line)
+
+    def _accept(self, line):
+        """Return the lines released by this one; blank lines are held until more code follows"""
+        if not line.strip():
+            self.pending_blank += 1
+            return []
+
+        code = normalize_code_line(line)
+        if self._past_end(code):
+            self.finished = True
+            return []
+
+        if code:
+            window = self.expected[self.matched:self.matched + MATCH_WINDOW]
+            if code in window:
+                self.matched += window.index(code) + 1
+            self.depth += brace_delta(code)
+            self.opened = self.opened or self.depth > 0
+
+        released = [""] * self.pending_blank if self.lines else []
+        self.pending_blank = 0
+        released.append(line)
+        self.lines.extend(released)
+        self.labels.extend(parse_labels(released_line) for released_line in released)
+        return released
+
+    def _past_end(self, code):
+        if not code or code.startswith("```"):
+            return False
+        if self.expected and self.matched >= len(self.expected):
+            return True
+        return self.track_braces and self.opened and self.depth <= 0
+
+    def result(self):
+        return "\n".join(self.lines).strip()
+
+
+class ResultStreamWriter:
+    """Write results to the answer file line by line, in the same layout as the buffered output"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.entries = 0
+        self.header = None
+        self.written = 0
+        self.started = False
+
+    def begin(self, header):
+        self.header = header
+        self.written = 0
+        self.started = False
+
+    def write_lines(self, lines, skip=0):
+        """Write lines, skipping the first ones already written by an earlier attempt"""
+        for index, line in enumerate(lines, start=skip):
+            if index < self.written:
+                continue
+            if not self.started:
+                if self.entries:
+                    self.stream.write("\n/////\n")
+                self.stream.write(f"{self.header}:\n")
+                self.started = True
+            self.stream.write(line + "\n")
+            self.written += 1
+        self.stream.flush()
+
+    def end(self):
+        if self.started:
+            self.entries += 1
+
+
+def stream_completion(chunks, input_lines, writer=None):
+    """Parse a token stream, writing completed lines as they arrive and stopping at runaway output"""
+    parser = LabelledLineParser(input_lines)
+    emitted = 0
+    try:
+        for chunk in chunks:
+            lines = parser.feed(chunk)
+            if writer is not None:
+                writer.write_lines(lines, skip=emitted)
+            emitted += len(lines)
+            if parser.finished:
+                print(f"Stopping stream: output continued past the end of the input ({emitted} lines kept)")
+                break
+        lines = parser.close()
+        if writer is not None:
+            writer.write_lines(lines, skip=emitted)
+    finally:
+        # Closing the generator cancels the underlying HTTP stream
+        if hasattr(chunks, "close"):
+            chunks.close()
+    return parser.result()
@@ -0,0 +1,93 @@
+import json
+from alignment import align_lines
+from streaming import parse_labels
+
+COLUMNS = ["file", "function", "line", "code", "labels", "block", "kb_ids", "latency_ms"]
+
+
+def label_lines(input_lines, result):
+    """Labels the model gave each input line, found by aligning its answer to the input"""
+    result_lines = result.split("\n")
+    labels = [[] for _ in input_lines]
+    for input_index, result_index in align_lines(input_lines, result_lines):
+        labels[input_index] = parse_labels(result_lines[result_index])
+    return labels
+
+
+def function_records(file_name, function_index, input_lines, block_results):
+    """One record per input line of a function
+
+    block_results holds (block_index, start_line, block_lines, result, provenance)
+    for each block; a line in the overlap of two blocks is taken from the first.
+    Lines of blocks whose detection failed are left out.
+    """
+    records = {}
+    for block_index, start, block_lines, result, provenance in block_results:
+        if result is None:
+            continue
+        for offset, labels in enumerate(label_lines(block_lines, result)):
+            line_index = start + offset
+            if line_index in records:
+                continue
+            records[line_index] = {
+                "file": file_name,
+                "function": function_index + 1,
+                "line": line_index + 1,
+                "code": input_lines[line_index],
+                "labels": labels,
+                "block": None if block_index is None else block_index + 1,
+                "kb_ids": provenance.get("kb_ids", []),
+                "latency_ms": provenance.get("latency_ms"),
+            }
+    return [records[line_index] for line_index in sorted(records)]
+
+
+class JsonlWriter:
+    """Append records to a JSONL file as they are produced"""
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.stream = open(file_path, "w", encoding="utf-8")
+
+    def write(self, records):
+        for record in records:
+            self.stream.write(json.dumps(record) + "\n")
+        self.stream.flush()
+
+    def close(self):
+        self.stream.close()
+
+
+def load_records(file_path):
+    with open(file_path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def load_columns(file_path):
+    """Load a JSONL result file as a dict of columns"""
+    records = load_records(file_path)
+    return {column: [record.get(column) for record in records] for column in COLUMNS}
+
+
+def export_parquet(jsonl_path, parquet_path):
+    """Write the records of a JSONL result file as a Parquet table (requires pyarrow)"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        print("Warning: pyarrow is not installed, skipping Parquet export")
+        return
+    pq.write_table(pa.table(load_columns(jsonl_path)), parquet_path)
+    print(f"Columnar results written to {parquet_path}")
+
+
+def records_to_text(records):
+    """Rebuild the labelled functions, separated by /////, from line records"""
+    functions = []
+    for record in records:
+        key = (record["file"], record["function"])
+        if not functions or functions[-1][0] != key:
+            functions.append((key, []))
+        labels = "".join(f" //{label}" for label in record["labels"])
+        functions[-1][1].append(record["code"] + labels)
+    return "\n/////\n".join("\n".join(lines) for _, lines in functions)
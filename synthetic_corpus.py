@@ -0,0 +1,195 @@
+import os
+import re
+import random
+import argparse
+from alignment import split_functions
+from context_builder import parse_kb_entry
+from streaming import brace_delta
+
+CUR_DIR = os.path.dirname(os.path.abspath(__file__))
+GROUND_TRUTH_DIR = os.path.join(CUR_DIR, "Ground truth")
+KNOWLEDGE_BASE = os.path.join(CUR_DIR, "fidelity_new.c")
+
+SIZE_PATTERN = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([KMG]?)B?\s*$', re.IGNORECASE)
+LABEL_TAIL_PATTERN = re.compile(r'\s*//\s*I\d.*$')
+TEMPORARY_PATTERN = re.compile(r'\bv(\d+)\b')
+OFFSET_PATTERN = re.compile(r'(\+\s*)(\d+)(LL)?(\s*\))')
+FUNCTION_NAME_PATTERN = re.compile(r'([A-Za-z_]\w*)(\s*\()')
+# Lines that continue the statement before them
+CONTINUATION_PATTERN = re.compile(r'^\s*(?:else\b|while\b.*\)\s*;)')
+
+# Chance per function of each mutation
+KB_INSERT_RATE = 0.5
+GROW_RATE = 0.2
+
+
+def parse_size(text: str) -> int:
+    """Bytes in a size such as 500K, 20MB or 1.5G"""
+    size = SIZE_PATTERN.match(text)
+    if not size:
+        raise argparse.ArgumentTypeError(f"Invalid size: {text}")
+    return int(float(size.group(1)) * 1024 ** " KMG".index((size.group(2) or " ").upper()))
+
+
+def split_label(line: str) -> tuple:
+    """(code, labels) of a ground truth line"""
+    tail = LABEL_TAIL_PATTERN.search(line)
+    if not tail:
+        return line.rstrip(), []
+    return line[:tail.start()].rstrip(), re.findall(r'I[1-6]', tail.group())
+
+
+def load_sources(ground_truth_dir: str = GROUND_TRUTH_DIR, knowledge_base: str = KNOWLEDGE_BASE) -> tuple:
+    """Labelled functions of the ground truth, and single-statement KB entries to splice into them"""
+    functions = []
+    for file in sorted(os.listdir(ground_truth_dir)):
+        with open(os.path.join(ground_truth_dir, file), "r", encoding="utf-8") as f:
+            for lines in split_functions(f.read().replace("\r\n", "\n")):
+                if len(lines) > 2:
+                    functions.append([split_label(line) for line in lines])
+    kb_entries = []
+    with open(knowledge_base, "r", encoding="utf-8") as f:
+        for line in f:
+            code, label, explanation = parse_kb_entry(line)
+            if label and code.endswith(";") and brace_delta(code) == 0:
+                kb_entries.append((code, [label]))
+    return functions, kb_entries
+
+
+class CorpusGenerator:
+    """Seeded generator of labelled functions mutated and recombined from the ground truth
+
+    Each function is a ground truth function with its name made unique, its
+    vN temporaries renumbered and its struct offsets changed; some get
+    labelled knowledge base statements spliced in, and some grow past the
+    block size by repeating a balanced run of their own statements. Labels
+    move with their lines, so the output stays a valid ground truth.
+    """
+
+    def __init__(self, seed: int, functions: list, kb_entries: list):
+        self.random = random.Random(seed)
+        self.functions = functions
+        self.kb_entries = kb_entries
+
+    def function(self, index: int) -> list:
+        lines = list(self.random.choice(self.functions))
+        shift = self.random.randrange(0, 32)
+        scale = self.random.choice((1, 2, 4))
+        lines = [(self._rewrite(code, shift, scale), labels) for code, labels in lines]
+
+        # The header keeps its signature with a unique name
+        header = FUNCTION_NAME_PATTERN.search(lines[0][0])
+        if header:
+            code = lines[0][0]
+            lines[0] = (code[:header.end(1)] + f"_s{index}" + code[header.end(1):], lines[0][1])
+
+        if self.kb_entries and self.random.random() < KB_INSERT_RATE:
+            for _ in range(self.random.randint(1, 3)):
+                self._insert_kb_statement(lines)
+        if self.random.random() < GROW_RATE:
+            self._grow(lines)
+        return lines
+
+    @staticmethod
+    def _rewrite(code: str, shift: int, scale: int) -> str:
+        code = TEMPORARY_PATTERN.sub(lambda m: f"v{int(m.group(1)) + shift}", code)
+        return OFFSET_PATTERN.sub(lambda m: f"{m.group(1)}{int(m.group(2)) * scale}{m.group(3) or ''}{m.group(4)}", code)
+
+    def _statement_boundaries(self, lines: list) -> list:
+        """Body positions after a complete statement or an opening brace, not splitting if/else or do/while"""
+        return [
+            index for index in range(2, len(lines) - 1)
+            if lines[index - 1][0].rstrip().endswith((";", "{", "}"))
+            and not CONTINUATION_PATTERN.match(lines[index][0])
+        ]
+
+    def _insert_kb_statement(self, lines: list):
+        boundaries = self._statement_boundaries(lines)
+        if not boundaries:
+            return
+        index = self.random.choice(boundaries)
+        following = lines[index][0]
+        indent = following[:len(following) - len(following.lstrip())] or "  "
+        code, labels = self.random.choice(self.kb_entries)
+        lines.insert(index, (indent + code, labels))
+
+    def _grow(self, lines: list):
+        """Repeat brace-balanced runs of statements until the function is longer than a block"""
+        boundaries = self._statement_boundaries(lines)
+        while len(lines) <= 60 and boundaries:
+            start = self.random.choice(boundaries)
+            end = self._balanced_run_end(lines, start)
+            if end is None:
+                boundaries.remove(start)
+                continue
+            lines[end + 1:end + 1] = lines[start:end + 1]
+            boundaries = self._statement_boundaries(lines)
+
+    @staticmethod
+    def _balanced_run_end(lines: list, start: int):
+        """Last line of the shortest run of at least three lines from start that closes every brace it opens"""
+        depth = 0
+        for end in range(start, len(lines) - 1):
+            depth += brace_delta(lines[end][0])
+            if depth < 0:
+                return None
+            if depth == 0 and end - start >= 2 and lines[end][0].rstrip().endswith((";", "}")):
+                return end
+        return None
+
+
+def generate_corpus(output_dir: str, total_size: int, file_size: int, seed: int) -> dict:
+    """Write Dataset/ and Ground truth/ files under output_dir until the Dataset side reaches total_size bytes"""
+    functions, kb_entries = load_sources()
+    generator = CorpusGenerator(seed, functions, kb_entries)
+    dataset_dir = os.path.join(output_dir, "Dataset")
+    ground_truth_dir = os.path.join(output_dir, "Ground truth")
+    os.makedirs(dataset_dir, exist_ok=True)
+    os.makedirs(ground_truth_dir, exist_ok=True)
+
+    written = 0
+    stats = {"files": 0, "functions": 0, "labels": 0, "bytes": 0}
+    while written < total_size:
+        name = f"synthetic_{stats['files'] + 1:04d}"
+        dataset_path = os.path.join(dataset_dir, f"{name}.txt")
+        ground_truth_path = os.path.join(ground_truth_dir, f"{name}-GT.txt")
+        with open(dataset_path, "w", encoding="utf-8") as dataset_file, \
+                open(ground_truth_path, "w", encoding="utf-8") as ground_truth_file:
+            file_written = 0
+            while file_written < file_size and written + file_written < total_size:
+                lines = generator.function(stats["functions"])
+                code = "\n".join(code for code, labels in lines)
+                labelled = "\n".join(
+                    code + (" // " + " ".join(labels) if labels else "") for code, labels in lines
+                )
+                separator = "\n/////\n" if file_written else ""
+                dataset_file.write(separator + code)
+                ground_truth_file.write(separator + labelled)
+                file_written += len(separator) + len(code.encode("utf-8"))
+                stats["functions"] += 1
+                stats["labels"] += sum(len(labels) for code, labels in lines)
+        written += file_written
+        stats["files"] += 1
+    stats["bytes"] = written
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate a large labelled corpus from the bundled ground truth for load and scaling tests."
+    )
+    parser.add_argument('--output_dir', type=str, default='synthetic', help="Directory for Dataset/ and Ground truth/.")
+    parser.add_argument('--size', type=parse_size, default='10MB', help="Total Dataset size, e.g. 500K, 20MB, 2G.")
+    parser.add_argument('--file-size', type=parse_size, default='8MB', help="Size of each generated input file.")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed; the same seed gives the same corpus.")
+    args = parser.parse_args()
+
+    stats = generate_corpus(args.output_dir, args.size, args.file_size, args.seed)
+    print(
+        f"Wrote {stats['functions']} functions with {stats['labels']} labels "
+        f"({stats['bytes'] / 2 ** 20:.1f} MB) in {stats['files']} files to {args.output_dir}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import os
+import json
+import threading
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str):
+    """Load the tiktoken encoding for a model, or None when it is unavailable"""
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # tiktoken downloads encodings on first use, which fails offline
+        print(f"Warning: Cannot load tiktoken encoding for {model} ({e}), estimating token counts")
+        return None
+
+
+def count_tokens(text: str, model: str = "gpt-4o") -> int:
+    """Count prompt tokens locally, estimating four characters per token without tiktoken"""
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+class BudgetExceededError(Exception):
+    """Raised before an LLM call that would take the run over its token budget"""
+
+
+class TokenLedger:
+    """Per-run token accounting, aggregated by stage, file and function, with an optional hard budget"""
+
+    def __init__(self, max_tokens: int, degrade_at: float, prompt_price: float, completion_price: float):
+        self.max_tokens = max_tokens
+        self.degrade_at = degrade_at
+        self.prompt_price = prompt_price
+        self.completion_price = completion_price
+        self.totals = {"stage": {}, "file": {}, "function": {}}
+        self.used = 0
+        self.failed = []
+        self.shared = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def share_usage(self, shared):
+        """Check the budget against the tokens of all workers recorded in shared (a work_queue.SharedUsage)"""
+        self.shared = shared
+
+    def budget_used(self) -> int:
+        return self.shared.total() if self.shared is not None else self.used
+
+    def set_context(self, file: str, function: str):
+        """Attribute the following calls of this thread to a file and function"""
+        self.local.file = file
+        self.local.function = function
+
+    def check(self, estimated_tokens: int):
+        """Refuse a call whose estimated tokens do not fit in the remaining budget"""
+        with self.lock:
+            used = self.budget_used()
+            if self.max_tokens and used + estimated_tokens > self.max_tokens:
+                raise BudgetExceededError(
+                    f"Token budget exhausted: {used} of {self.max_tokens} used, next call needs ~{estimated_tokens}"
+                )
+
+    def degraded(self) -> bool:
+        """Whether optional stages (the redundant-variable call) should be skipped to save budget"""
+        if not self.max_tokens:
+            return False
+        with self.lock:
+            return self.budget_used() >= self.degrade_at * self.max_tokens
+
+    def context(self) -> tuple:
+        """This thread's (file, function), to charge a call finishing on another thread"""
+        return getattr(self.local, "file", ""), getattr(self.local, "function", "")
+
+    def charge(self, stage: str, prompt_tokens: int, completion_tokens: int, context: tuple = None):
+        file, function = context if context is not None else self.context()
+        with self.lock:
+            self.used += prompt_tokens + completion_tokens
+            if self.shared is not None:
+                self.shared.add(prompt_tokens + completion_tokens)
+            for group, key in (("stage", stage), ("file", file), ("function", f"{file}:{function}")):
+                entry = self.totals[group].setdefault(key, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0})
+                entry["calls"] += 1
+                entry["prompt_tokens"] += prompt_tokens
+                entry["completion_tokens"] += completion_tokens
+
+    def record_failure(self, label: str, error: str):
+        """Note a detection whose result is missing from the output, under this thread's file"""
+        with self.lock:
+            self.failed.append({"file": getattr(self.local, "file", ""), "label": label, "error": error})
+
+    def cost(self, entry: dict) -> float:
+        return (entry["prompt_tokens"] * self.prompt_price + entry["completion_tokens"] * self.completion_price) / 1000
+
+    def report(self) -> str:
+        lines = [f"Tokens used: {self.used}" + (f" of {self.max_tokens}" if self.max_tokens else "")]
+        for stage, entry in self.totals["stage"].items():
+            lines.append(
+                f"  {stage}: {entry['calls']} calls, {entry['prompt_tokens']} prompt + "
+                f"{entry['completion_tokens']} completion tokens, ${self.cost(entry):.4f}"
+            )
+        if self.failed:
+            lines.append(f"  failed detections: {len(self.failed)} (listed under failed in run_report.json)")
+        return "\n".join(lines)
+
+    def to_dict(self) -> dict:
+        return {
+            "max_tokens": self.max_tokens,
+            "used_tokens": self.used,
+            "cost": round(sum(self.cost(entry) for entry in self.totals["stage"].values()), 6),
+            "totals": self.totals,
+            "failed": self.failed,
+        }
+
+
+@lru_cache(maxsize=None)
+def get_ledger() -> TokenLedger:
+    """Process-wide ledger shared by detection, variable analysis and correction"""
+    from config import load_config
+
+    return TokenLedger(
+        max_tokens=int(load_config("BUDGET", "max_tokens", "0")),
+        degrade_at=float(load_config("BUDGET", "degrade_at", "0.8")),
+        prompt_price=float(load_config("BUDGET", "prompt_price_per_1k", "0.0025")),
+        completion_price=float(load_config("BUDGET", "completion_price_per_1k", "0.01")),
+    )
+
+
+def write_run_report(output_dir: str, report: dict):
+    """Write the run report JSON next to the results"""
+    file_path = os.path.join(output_dir, "run_report.json")
+    with open(file_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Run report written to {file_path}")
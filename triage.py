@@ -0,0 +1,131 @@
+import os
+import re
+import json
+import threading
+from config import load_config, set_llm_environment
+from context_builder import cluster_key, parse_kb_entry
+from document_processor import normalize_code_line
+from pattern_matcher import calculate_max_semantic_strength
+
+# Local signs of the distortion types the detection prompt asks about
+INDICATOR_PATTERNS = {
+    "I1": re.compile(r'\*\s*\(\s*[\w ]+\*+\s*\)|\(\s*\w+\s*[+-]\s*\d+\s*\)|\b[av]\d+\[\d+\]'),
+    "I2": re.compile(r'(?<![\w.])(?:0x[0-9A-Fa-f]+|\d{2,})(?:u?LL|u)?\b'),
+    "I3": re.compile(r'\bgoto\b|\bwhile\s*\(\s*1\s*\)|^do\b'),
+    "I4": re.compile(r'\bv\d+\b'),
+    "I6": re.compile(r'\b(?:[LH]O(?:BYTE|WORD|DWORD)|BYTE\d|WORD\d|_(?:BYTE|WORD|DWORD|QWORD)|__\w+)\b'),
+}
+ROUTES = ("skip", "cheap", "full")
+
+
+class Triage:
+    """Score how likely a function is to contain distortions, before any LLM call
+
+    The score is the share of body lines showing a local distortion indicator,
+    a _TYPE category hit from the pattern matcher, or the structure of a
+    knowledge base example; KB structural hits count twice.
+    """
+
+    def __init__(self, knowledge_base_file: str, weights: dict, log_file: str = ""):
+        self.weights = weights
+        self.log_file = log_file
+        self.cheap_llm = None
+        self.kb_shapes = set()
+        try:
+            with open(knowledge_base_file, "r", encoding="utf-8") as f:
+                for line in f:
+                    code, label, explanation = parse_kb_entry(line)
+                    if label:
+                        self.kb_shapes.add(cluster_key(code, "")[1])
+        except FileNotFoundError:
+            print(f"Warning: Cannot find file {knowledge_base_file}, triage runs without KB structural hits")
+        self.skip_below = float(load_config("TRIAGE", "skip_below", "0"))
+        self.cheap_below = float(load_config("TRIAGE", "cheap_below", "0"))
+        self.stats = {route: {"functions": 0, "labelled_lines": 0, "functions_with_labels": 0} for route in ROUTES}
+        self.lock = threading.Lock()
+
+    def score(self, lines) -> float:
+        body = [normalize_code_line(line) for line in lines[1:]]
+        body = [line for line in body if line and line not in ('{', '}')]
+        if not body:
+            return 0.0
+        hits = 0
+        for line in body:
+            if cluster_key(line, "")[1] in self.kb_shapes:
+                hits += 2
+            elif any(pattern.search(line) for pattern in INDICATOR_PATTERNS.values()):
+                hits += 1
+            elif calculate_max_semantic_strength(line, self.weights)[0] == '_TYPE':
+                hits += 1
+        return min(1.0, hits / len(body))
+
+    def route(self, lines) -> tuple:
+        """Return (route, score): skip the LLM, use the cheap model, or run the full detection prompt"""
+        score = self.score(lines)
+        if score < self.skip_below:
+            return "skip", score
+        if score < self.cheap_below:
+            return "cheap", score
+        return "full", score
+
+    def get_cheap_llm(self):
+        with self.lock:
+            if self.cheap_llm is None:
+                from langchain_openai import ChatOpenAI
+
+                set_llm_environment()
+                self.cheap_llm = ChatOpenAI(
+                    model=load_config("TRIAGE", "cheap_model", "gpt-4o-mini"),
+                    temperature=float(load_config("LLM", "temperature")),
+                )
+            return self.cheap_llm
+
+    def run(self, file_name: str, query_index: int, query: str, llm, detect):
+        """Route one function and detect it; detect(llm) runs the LLM detection and returns its detections
+
+        A skipped function comes back unlabelled as a single (None, function) detection.
+        """
+        route, score = self.route(query.strip().split("\n"))
+        if route == "skip":
+            print(f"Triage: skipping Query {query_index + 1} of {file_name} (score {score:.2f})")
+            detections = [(None, query.strip())]
+        else:
+            detections = detect(self.get_cheap_llm() if route == "cheap" else llm)
+        self.record(file_name, query_index, route, score, "\n".join(result for _, result in detections if result))
+        return detections, route
+
+    def record(self, file_name: str, query_index: int, route: str, score: float, result):
+        """Log one routing decision with its outcome: how many lines the model labelled"""
+        labelled_lines = 0
+        if result:
+            labelled_lines = sum(1 for line in result.split("\n") if re.search(r'//\s*I\d', line))
+        with self.lock:
+            stats = self.stats[route]
+            stats["functions"] += 1
+            stats["labelled_lines"] += labelled_lines
+            stats["functions_with_labels"] += labelled_lines > 0
+            if self.log_file:
+                with open(self.log_file, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({
+                        "file": file_name,
+                        "function": query_index + 1,
+                        "score": round(score, 3),
+                        "route": route,
+                        "labelled_lines": labelled_lines,
+                    }) + "\n")
+
+    def report(self) -> str:
+        lines = ["Triage routes:"]
+        for route, stats in self.stats.items():
+            lines.append(
+                f"  {route}: {stats['functions']} functions, "
+                f"{stats['functions_with_labels']} with labels, {stats['labelled_lines']} labelled lines"
+            )
+        return "\n".join(lines)
+
+
+def init_triage(knowledge_base_file: str, weights: dict, output_dir: str):
+    """Triage for this run, or None when [TRIAGE] is disabled; decisions are logged to triage_log.jsonl"""
+    if load_config("TRIAGE", "enabled", "false").lower() != "true":
+        return None
+    return Triage(knowledge_base_file, weights, os.path.join(output_dir, "triage_log.jsonl"))
@@ -1,62 +1,370 @@
-import os
 import re
-import networkx as nx
-from langchain.schema import HumanMessage
-from langchain.chat_models import ChatOpenAI
-from langchain.prompts import PromptTemplate
-import configparser
-
-CUR_DIR = os.path.dirname(os.path.abspath(__file__))
-CONFIG = os.path.join(CUR_DIR, 'config.ini')
-
-def load_config(field: str, value: str) -> str:
-    """Load parameters from config file"""
-    config = configparser.ConfigParser()
-    try:
-        config.read(CONFIG, encoding='utf-8')
-        return config[field][value]
-    except KeyError:
-        print(f"Error: Cannot find [{field}] {value} in config file")
-        sys.exit(1)
-    except UnicodeDecodeError:
-        print(f"Error: Config file encoding issue. Please save config.ini as UTF-8")
-        sys.exit(1)
-
-
-os.environ["OPENAI_API_BASE"] = load_config('LLM', 'api_base')
-os.environ["OPENAI_API_KEY"] = load_config('LLM', 'api_key')
+from array import array
+from config import load_config, set_llm_environment
+from rate_limiter import get_rate_limiter
+from token_counter import count_tokens, get_ledger
+from streaming import STRING_OR_COMMENT_PATTERN
+
+CONTROL_PATTERN = re.compile(r'^(if|while|for|switch)\b')
+ELSE_IF_PATTERN = re.compile(r'^else\s+if\b')
+DO_PATTERN = re.compile(r'^do\b')
+GOTO_PATTERN = re.compile(r'^goto\s+(\w+)\s*;')
+LABEL_PATTERN = re.compile(r'^(?!default\b)(\w+)\s*:(?!:)')
+CASE_PATTERN = re.compile(r'^(?:case\b.*|default\s*):')
+INFINITE_LOOP_PATTERN = re.compile(r'^(?:while\s*\(\s*1\s*\)|for\s*\(\s*;\s*;\s*\))')
+
+
+def strip_comments(line):
+    """Code of a line with comments removed and string and char literals emptied to "" """
+    return STRING_OR_COMMENT_PATTERN.sub(lambda literal: '' if literal.group().startswith('/') else '""', line)
+
+
+class ControlFlowGraph:
+    """CFG of a decompiled C function with successor and predecessor lists in integer arrays (CSR layout)
+
+    Node k is the k-th statement line; a line such as "} else {" is split into
+    two nodes on the same line. Node `exit` is the virtual function exit.
+    """
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.node_lines = array('i')
+        self.code = []
+        for i, line in enumerate(lines):
+            code = strip_comments(line).strip()
+            if not code:
+                continue
+            # "} else {" and "} while ( x );" close a block and continue the statement
+            if code.startswith('}') and code[1:].strip():
+                self.node_lines.append(i)
+                self.code.append('}')
+                code = code[1:].strip()
+            self.node_lines.append(i)
+            self.code.append(code)
+        self.exit = len(self.code)
+        self.kinds = [self._classify(code) for code in self.code]
+        self.closers = self._match_braces()
+        self.labels = {}
+        for node, code in enumerate(self.code):
+            label = LABEL_PATTERN.match(code)
+            if label:
+                self.labels.setdefault(label.group(1), node)
+
+        self.edges = []
+        self.extents = {}
+        self.header_depths = {}
+        self._parse_range(0, self.exit, self.exit, {})
+        self._connect_dead_ends()
+        self.succ_start, self.succ_targets = self._compress(self.edges)
+        self.pred_start, self.pred_sources = self._compress([(target, source) for source, target in self.edges])
+        del self.edges
+
+    def _match_braces(self):
+        """closers[k] is the node closing the block opened at the end of node k (exit when unbalanced)"""
+        closers = {}
+        stack = []
+        for node, code in enumerate(self.code):
+            for char in code:
+                if char == '{':
+                    stack.append(node)
+                elif char == '}' and stack:
+                    closers[stack.pop()] = node
+        for node in stack:
+            closers[node] = self.exit
+        return closers
+
+    def _compress(self, edges):
+        """Sort (source, target) pairs into an offsets array and a targets array"""
+        edges = sorted(set(edges))
+        start = array('i', [0] * (self.exit + 2))
+        for source, _ in edges:
+            start[source + 1] += 1
+        for node in range(self.exit + 1):
+            start[node + 1] += start[node]
+        return start, array('i', [target for _, target in edges])
+
+    def successors(self, node):
+        return self.succ_targets[self.succ_start[node]:self.succ_start[node + 1]]
+
+    def predecessors(self, node):
+        return self.pred_sources[self.pred_start[node]:self.pred_start[node + 1]]
+
+    def _kind(self, node):
+        return self.kinds[node]
+
+    @staticmethod
+    def _classify(code):
+        if ELSE_IF_PATTERN.match(code):
+            return 'if'
+        control = CONTROL_PATTERN.match(code)
+        if control:
+            return control.group(1)
+        if code.startswith('else'):
+            return 'else'
+        if DO_PATTERN.match(code):
+            return 'do'
+        if code.startswith('{'):
+            return 'block'
+        return 'simple'
+
+    def _header_end(self, node):
+        """Last node of a control header whose condition may span several lines"""
+        depth = 0
+        for current in range(node, self.exit):
+            code = self.code[current]
+            self.header_depths[current] = depth
+            depth += code.count('(') - code.count(')')
+            if depth <= 0:
+                return current
+        return self.exit - 1
+
+    def _opens_block(self, node):
+        return self.code[node].endswith('{')
+
+    def _inline_body(self, header_end):
+        """Statement written on the header line after the condition, e.g. "if ( a1 ) return 0;" """
+        code = self.code[header_end]
+        depth = self.header_depths.get(header_end, 0)
+        for index, char in enumerate(code):
+            depth += (char == '(') - (char == ')')
+            if char == ')' and depth == 0:
+                return code[index + 1:].strip()
+        return ''
+
+    def _body_end(self, header_end):
+        """Node after the body that follows a control header"""
+        if self._opens_block(header_end):
+            return min(self.closers[header_end] + 1, self.exit)
+        if self._inline_body(header_end) and self._kind(header_end) != 'else':
+            return header_end + 1
+        if self._kind(header_end) == 'else' and self.code[header_end] != 'else':
+            return header_end + 1
+        return self._statement_end(header_end + 1)
+
+    def _statement_end(self, node):
+        """Node after the statement starting at node"""
+        if node >= self.exit:
+            return self.exit
+        if node in self.extents:
+            return self.extents[node]
+        kind = self._kind(node)
+        if kind == 'block':
+            end = min(self.closers[node] + 1, self.exit)
+        elif kind in ('if', 'while', 'for', 'switch'):
+            end = self._body_end(self._header_end(node))
+            if kind == 'if' and end < self.exit and self._kind(end) in ('else', 'if') and self.code[end].startswith('else'):
+                end = self._statement_end(end) if self._kind(end) == 'if' else self._body_end(end)
+        elif kind == 'do':
+            end = self._body_end(node)
+            if end < self.exit and self.code[end].startswith('while'):
+                end = self._header_end(end) + 1
+        else:
+            end = node + 1
+            # Statements wrapped over several lines end at the line with the semicolon
+            while not self.code[end - 1].endswith((';', '{', '}', ':')) and end < self.exit and self._kind(end) == 'simple':
+                end += 1
+        self.extents[node] = min(end, self.exit)
+        return self.extents[node]
+
+    def _parse_range(self, start, end, follow, targets):
+        """Wire the statements of nodes start..end-1 in sequence, the last one falling through to follow"""
+        node = start
+        while node < end:
+            next_node = min(self._statement_end(node), end)
+            self._parse_statement(node, next_node, next_node if next_node < end else follow, targets)
+            node = next_node
+
+    def _chain(self, start, last):
+        for node in range(start, last):
+            self.edges.append((node, node + 1))
+
+    def _wire_body(self, header_end, follow, targets):
+        """Wire the body after a control header and return its entry node"""
+        if self._opens_block(header_end):
+            closer = self.closers[header_end]
+            close_target = closer if closer < self.exit else follow
+            self._parse_range(header_end + 1, min(closer, self.exit), close_target, targets)
+            if closer < self.exit:
+                self.edges.append((closer, follow))
+            return header_end + 1 if header_end + 1 < closer else close_target
+        body = self._inline_body(header_end) if self._kind(header_end) != 'else' else self.code[header_end][4:].strip()
+        if body:
+            return self._jump_target(body, follow, targets)
+        if header_end + 1 >= self.exit:
+            # A header on the last line of a function split by read_queries has no body
+            return follow
+        body_end = self._statement_end(header_end + 1)
+        self._parse_statement(header_end + 1, body_end, follow, targets)
+        return header_end + 1
+
+    def _jump_target(self, code, follow, targets):
+        """Where control goes after a simple statement"""
+        goto = GOTO_PATTERN.match(code)
+        if goto:
+            return self.labels.get(goto.group(1), self.exit)
+        if re.match(r'^return\b', code):
+            return self.exit
+        if re.match(r'^break\s*;', code):
+            return targets.get('break', follow)
+        if re.match(r'^continue\s*;', code):
+            return targets.get('continue', follow)
+        return follow
+
+    def _parse_statement(self, node, end, follow, targets):
+        kind = self._kind(node)
+        if kind == 'block':
+            closer = self.closers[node]
+            close_target = closer if closer < self.exit else follow
+            self.edges.append((node, node + 1 if node + 1 < closer else close_target))
+            self._parse_range(node + 1, min(closer, self.exit), close_target, targets)
+            if closer < self.exit:
+                self.edges.append((closer, follow))
+        elif kind == 'if':
+            header_end = self._header_end(node)
+            self._chain(node, header_end)
+            then_end = self._body_end(header_end)
+            self.edges.append((header_end, self._wire_body(header_end, follow, targets)))
+            if then_end < end and self.code[then_end].startswith('else'):
+                self.edges.append((header_end, then_end))
+                if self._kind(then_end) == 'if':
+                    self._parse_statement(then_end, end, follow, targets)
+                else:
+                    self.edges.append((then_end, self._wire_body(then_end, follow, targets)))
+            else:
+                self.edges.append((header_end, follow))
+        elif kind in ('while', 'for'):
+            header_end = self._header_end(node)
+            self._chain(node, header_end)
+            loop_targets = dict(targets, **{'break': follow, 'continue': node})
+            self.edges.append((header_end, self._wire_body(header_end, node, loop_targets)))
+            if not INFINITE_LOOP_PATTERN.match(self.code[node]):
+                self.edges.append((header_end, follow))
+        elif kind == 'do':
+            condition = end - 1 if end - 1 > node and self.code[end - 1].endswith(';') else None
+            condition_start = self._body_end(node) if condition is not None else None
+            loop_follow = condition_start if condition_start is not None and condition_start < end else follow
+            loop_targets = dict(targets, **{'break': follow, 'continue': loop_follow})
+            self.edges.append((node, self._wire_body(node, loop_follow, loop_targets)))
+            if condition_start is not None and condition_start < end:
+                self._chain(condition_start, end - 1)
+                self.edges.append((end - 1, node))
+                self.edges.append((end - 1, follow))
+        elif kind == 'switch':
+            header_end = self._header_end(node)
+            self._chain(node, header_end)
+            switch_targets = dict(targets, **{'break': follow, 'cases': []})
+            self.edges.append((header_end, self._wire_body(header_end, follow, switch_targets)))
+            for case in switch_targets['cases']:
+                self.edges.append((header_end, case))
+            if not any(self.code[case].startswith('default') for case in switch_targets['cases']):
+                self.edges.append((header_end, follow))
+        else:
+            if CASE_PATTERN.match(self.code[node]) and 'cases' in targets:
+                targets['cases'].append(node)
+            last = end - 1
+            self._chain(node, last)
+            self.edges.append((last, self._jump_target(self.code[last], follow, targets)))
+
+    def _connect_dead_ends(self):
+        """Give nodes that cannot reach the exit (infinite loops) an edge to it, so post-dominators are defined"""
+        predecessors = [[] for _ in range(self.exit + 1)]
+        for source, target in self.edges:
+            predecessors[target].append(source)
+        reaches_exit = [False] * (self.exit + 1)
+        reaches_exit[self.exit] = True
+        stack = [self.exit]
+        while stack:
+            for source in predecessors[stack.pop()]:
+                if not reaches_exit[source]:
+                    reaches_exit[source] = True
+                    stack.append(source)
+        for node in range(self.exit - 1, -1, -1):
+            if not reaches_exit[node]:
+                self.edges.append((node, self.exit))
+                # Everything that reaches this node now reaches the exit too
+                stack = [node]
+                reaches_exit[node] = True
+                while stack:
+                    for source in predecessors[stack.pop()]:
+                        if not reaches_exit[source]:
+                            reaches_exit[source] = True
+                            stack.append(source)
+
 
 # Function to generate the control flow graph (CFG)
 def generate_cfg(c_code):
-    cfg = nx.DiGraph()
     lines = c_code.split('\n')
-    current_node = None
+    return ControlFlowGraph(lines), lines
 
-    for i, line in enumerate(lines):
-        line = line.strip()
-        if line:
-            cfg.add_node(i, code=line, type='statement')  # Add code information to node attributes
-            if current_node is not None:
-                cfg.add_edge(current_node, i)
-            current_node = i
-    return cfg, lines
-
-# Compute post-dominators
+# Compute post-dominators with the Cooper-Harvey-Kennedy algorithm on the reverse CFG
 def compute_post_dominators(cfg):
-    post_dominators = nx.immediate_dominators(cfg.reverse(), list(cfg.nodes)[-1])
-    return post_dominators
+    """Immediate post-dominator of every node, as an array indexed by node (the exit maps to itself)"""
+    # Reverse postorder of the reverse CFG, starting from the exit
+    postorder = array('i', [-1] * (cfg.exit + 1))
+    order = []
+    visited = [False] * (cfg.exit + 1)
+    visited[cfg.exit] = True
+    stack = [(cfg.exit, iter(cfg.predecessors(cfg.exit)))]
+    while stack:
+        node, children = stack[-1]
+        for child in children:
+            if not visited[child]:
+                visited[child] = True
+                stack.append((child, iter(cfg.predecessors(child))))
+                break
+        else:
+            stack.pop()
+            postorder[node] = len(order)
+            order.append(node)
+    order.reverse()
+
+    ipdom = array('i', [-1] * (cfg.exit + 1))
+    ipdom[cfg.exit] = cfg.exit
+    changed = True
+    while changed:
+        changed = False
+        for node in order[1:]:
+            new_ipdom = -1
+            for succ in cfg.successors(node):
+                if ipdom[succ] == -1:
+                    continue
+                if new_ipdom == -1:
+                    new_ipdom = succ
+                    continue
+                # Walk both fingers up the post-dominator tree until they meet
+                finger1, finger2 = succ, new_ipdom
+                while finger1 != finger2:
+                    while postorder[finger1] < postorder[finger2]:
+                        finger1 = ipdom[finger1]
+                    while postorder[finger2] < postorder[finger1]:
+                        finger2 = ipdom[finger2]
+                new_ipdom = finger1
+            if ipdom[node] != new_ipdom:
+                ipdom[node] = new_ipdom
+                changed = True
+    return ipdom
 
 # Generate control dependence subgraph
 def generate_control_dependence_subgraph(cfg, post_dominators):
+    """Edges from each branch line to the lines it controls, between line indices"""
+    import networkx as nx
+
     cdg = nx.DiGraph()
-    for node in cfg.nodes:
+    for node in range(cfg.exit):
         for succ in cfg.successors(node):
-            if post_dominators[succ] != node:
-                cdg.add_edge(node, succ, type='control_dependence')
+            # Every node on the post-dominator tree path from succ up to ipdom(node) depends on node
+            runner = succ
+            while runner != post_dominators[node] and runner != cfg.exit and runner != -1:
+                source, target = cfg.node_lines[node], cfg.node_lines[runner]
+                if source != target:
+                    cdg.add_edge(source, target, type='control_dependence')
+                runner = post_dominators[runner]
     return cdg
 
 # Generate data dependence subgraph
 def generate_data_dependence_subgraph(lines):
+    import networkx as nx
+
     ddg = nx.DiGraph()
     var_def = {}
 
@@ -97,6 +405,8 @@ def extract_variable_definitions(c_code):
 
 # Generate the PDG
 def generate_pdg(c_code):
+    import networkx as nx
+
     cfg, lines = generate_cfg(c_code)
     post_dominators = compute_post_dominators(cfg)
     cdg = generate_control_dependence_subgraph(cfg, post_dominators)
@@ -111,24 +421,26 @@ def find_variable_dependencies(pdg, variable_name, lines):
     dep_info = []
 
     def recursive_find(var_name):
-        for node, data in pdg.nodes(data=True):
-            if isinstance(node, str) and node == var_name:
-                for pred in pdg.predecessors(node):
-                    if pred not in dependencies:
-                        dependencies.add(pred)
-                        if isinstance(pred, int):
-                            expr = lines[pred].split('=', 1)[1].strip() if '=' in lines[pred] else ''
-                            dep_info.append(lines[pred])
-                            vars_in_expr = extract_variables(expr)
-                            for var in vars_in_expr:
-                                if var != var_name:  # Avoid circular dependencies
-                                    recursive_find(var)
+        if var_name not in pdg:
+            return
+        for pred in pdg.predecessors(var_name):
+            if pred not in dependencies:
+                dependencies.add(pred)
+                if isinstance(pred, int):
+                    expr = lines[pred].split('=', 1)[1].strip() if '=' in lines[pred] else ''
+                    dep_info.append(lines[pred])
+                    vars_in_expr = extract_variables(expr)
+                    for var in vars_in_expr:
+                        if var != var_name:  # Avoid circular dependencies
+                            recursive_find(var)
 
     recursive_find(variable_name)
     return dep_info
 
 # Generate the prompt template
 def create_variable_template():
+    from langchain.prompts import PromptTemplate
+
     template = """
 As a program analysis expert, you possess excellent program analysis skills. Below are the variable dependencies extracted from decompiled code. During the decompilation process, new variables are defined due to register usage, which leads to a large number of redundant variables compared to the all_source_code code. Redundant variables refer to those that are temporary, intermediate, or represent the same data. These variables are often generated during the decompilation process due to register operations or temporary storage needs. Considering temporary or intermediate calculation results, these variables are only used for intermediate steps in computations or operations and are not utilized multiple times or have no significant independent meaning. Repetitively, these variables store the same or similar information and can logically be merged with other statements. The task is to directly output potentially redundant variables without any explanation. The output format is as follows:
 **Potential redundant variables:** {all_vars}.
@@ -144,9 +456,20 @@ def format_prompt(all_dependencies):
     return prompt_template.format(all_vars="All variables", question=question)
 
 # Function to call the OpenAI LLM (ChatGPT)
-def call_llm(prompt):
+def call_llm(prompt, variables):
+    from langchain.schema import HumanMessage
+    from langchain.chat_models import ChatOpenAI
+
+    set_llm_environment()
     llm = ChatOpenAI(model='gpt-4o', temperature=0.5)  
-    response = llm([HumanMessage(content=prompt)])
+    prompt_tokens = count_tokens(prompt)
+    # The answer names at most every variable it was given
+    tokens = prompt_tokens + count_tokens(format_redundant_variables(variables))
+    get_ledger().check(tokens)
+    response = get_rate_limiter().call(
+        lambda: llm([HumanMessage(content=prompt)]), tokens, prompt_tokens=prompt_tokens
+    )
+    get_ledger().charge("variables", prompt_tokens, count_tokens(response.content))
     return response.content
 
 def generate_and_query_llm(c_code):
@@ -160,10 +483,12 @@ def generate_and_query_llm(c_code):
 
 
     all_dependencies = []
+    queried_vars = []
     for var in sorted(all_vars):
         dependencies = find_variable_dependencies(pdg, var, lines)
         if dependencies:
             all_dependencies.append(f"\nDependencies for variable '{var}':\n" + "\n".join(dependencies))
+            queried_vars.append(var)
 
 
     if all_dependencies:
@@ -171,9 +496,139 @@ def generate_and_query_llm(c_code):
         # print("\nGenerated Prompt:\n", prompt)
 
 
-        response = call_llm(prompt)
+        response = call_llm(prompt, queried_vars)
         return response
 
 
+DECLARATION_PATTERN = re.compile(r'^(?:[A-Za-z_]\w*\s+)+(?:\*+\s*)?([A-Za-z_]\w*)(?:\[\w*\])?\s*;$')
+ASSIGNMENT_PATTERN = re.compile(r'^([A-Za-z_]\w*)\s*(=(?!=)|[-+*/%&|^]=|<<=|>>=)\s*(.*?)\s*;?$')
+COPY_PATTERN = re.compile(r'^(?:\(\s*[\w\s*]+\)\s*)*([A-Za-z_]\w*)$')
+IDENTIFIER_PATTERN = re.compile(r'\b[A-Za-z_]\w*\b')
+STATEMENT_KEYWORDS = {"return", "goto", "if", "else", "while", "for", "do", "sizeof", "switch", "case", "break", "continue"}
+
+# Find redundant variables locally with def-use and liveness analysis on the CFG
+def find_redundant_variables(c_code):
+    r"""Local variables that look redundant, mapped to the reason, in declaration order
+
+    unused: declared but never read; dead store: a value assigned and never
+    read on any path; copy: only ever assigned a copy of another variable;
+    single-use temporary: assigned once and read once. Variables whose address
+    is taken are never reported. IDA's stack-slot comments on declarations
+    are ignored:
+
+    >>> find_redundant_variables(
+    ...     "int __cdecl f(int a1)\n{\n  int v1; // [esp+Ch] [ebp-Ch]\n  _DWORD *v2; // eax\n"
+    ...     "  char s[16]; // [esp+10h] [ebp-18h] BYREF\n\n  v1 = a1 + 1;\n  v2 = 0;\n  return v1;\n}"
+    ... )
+    {'v1': 'single-use temporary', 'v2': 'unused', 's': 'unused'}
+    """
+    cfg, lines = generate_cfg(c_code)
+
+    # Locals are the variables with a declaration line
+    local_vars = {}
+    declarations = set()
+    for node, code in enumerate(cfg.code):
+        declaration = DECLARATION_PATTERN.match(code)
+        if declaration and code.split()[0] not in STATEMENT_KEYWORDS:
+            local_vars.setdefault(declaration.group(1), len(local_vars))
+            declarations.add(node)
+    if not local_vars:
+        return {}
+
+    # Per node def and use sets as bitsets over the locals
+    defs = [0] * (cfg.exit + 1)
+    uses = [0] * (cfg.exit + 1)
+    def_count = dict.fromkeys(local_vars, 0)
+    use_count = dict.fromkeys(local_vars, 0)
+    copy_only = dict.fromkeys(local_vars, True)
+    address_taken = set(re.findall(r'&\s*([A-Za-z_]\w*)', "\n".join(cfg.code)))
+    for node, code in enumerate(cfg.code):
+        if node in declarations:
+            continue
+        assignment = ASSIGNMENT_PATTERN.match(code)
+        read_code = code
+        if assignment and assignment.group(1) in local_vars:
+            var = assignment.group(1)
+            def_count[var] += 1
+            defs[node] |= 1 << local_vars[var]
+            if assignment.group(2) == '=':
+                read_code = assignment.group(3)
+                copy_only[var] = copy_only[var] and bool(COPY_PATTERN.match(read_code))
+            else:
+                copy_only[var] = False
+        for name in IDENTIFIER_PATTERN.findall(read_code):
+            if name in local_vars:
+                use_count[name] += 1
+                uses[node] |= 1 << local_vars[name]
+
+    # Backward liveness to a fixed point
+    live_in = [0] * (cfg.exit + 1)
+    live_out = [0] * (cfg.exit + 1)
+    changed = True
+    while changed:
+        changed = False
+        for node in range(cfg.exit - 1, -1, -1):
+            out = 0
+            for succ in cfg.successors(node):
+                out |= live_in[succ]
+            new_in = uses[node] | (out & ~defs[node])
+            if out != live_out[node] or new_in != live_in[node]:
+                live_out[node], live_in[node] = out, new_in
+                changed = True
+
+    dead_stores = set()
+    for node in range(cfg.exit):
+        dead = defs[node] & ~live_out[node] & ~uses[node]
+        for var, bit in local_vars.items():
+            if dead >> bit & 1:
+                dead_stores.add(var)
+
+    redundant = {}
+    for var in local_vars:
+        if var in address_taken:
+            continue
+        if use_count[var] == 0:
+            redundant[var] = "unused"
+        elif var in dead_stores:
+            redundant[var] = "dead store"
+        elif def_count[var] and copy_only[var]:
+            redundant[var] = "copy"
+        elif def_count[var] == 1 and use_count[var] == 1:
+            redundant[var] = "single-use temporary"
+    return redundant
+
+# Format the local candidates like the LLM answer the detection prompt expects
+def format_redundant_variables(redundant):
+    if not redundant:
+        return ""
+    return "**Potential redundant variables:** " + ", ".join(redundant) + "."
+
+# Refine the local candidates with the LLM, giving it their dependencies
+def refine_redundant_variables(c_code, redundant):
+    pdg, lines = generate_pdg(c_code)
+    all_dependencies = []
+    for var, reason in redundant.items():
+        dependencies = find_variable_dependencies(pdg, var, lines)
+        all_dependencies.append(f"\nDependencies for variable '{var}' ({reason}):\n" + "\n".join(dependencies))
+    if all_dependencies:
+        return call_llm(format_prompt(all_dependencies), list(redundant))
+    return ""
+
+def redundant_variable_names(c_code, allow_llm=True):
+    """Variable_names for the detection prompt, computed as set by [VARIABLES] mode
+
+    local: static analysis only; refine: static candidates checked by the LLM;
+    llm: the LLM over all variable dependencies. LLM modes fall back to the
+    static result when allow_llm is False (token budget nearly used).
+    """
+    mode = load_config("VARIABLES", "mode", "local")
+    if mode == "llm" and allow_llm:
+        return generate_and_query_llm(c_code) or ""
+    redundant = find_redundant_variables(c_code)
+    if mode == "refine" and allow_llm and redundant:
+        return refine_redundant_variables(c_code, redundant) or ""
+    return format_redundant_variables(redundant)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+from document_processor import FAILED_MARKER, read_queries, write_output
+from scheduler import estimate_cost
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    file TEXT NOT NULL,
+    query_index INTEGER NOT NULL,
+    query TEXT NOT NULL,
+    cost INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    records TEXT,
+    UNIQUE (file, query_index)
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, cost DESC, id);
+CREATE TABLE IF NOT EXISTS files (
+    file TEXT PRIMARY KEY,
+    total INTEGER NOT NULL,
+    merged INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS usage (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    tokens INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO usage (id, tokens) VALUES (0, 0);
+"""
+
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    """Durable queue of function-level detection tasks in a SQLite file
+
+    Workers on one machine, or on several machines sharing the file system,
+    claim tasks under a lease. A task whose worker died is handed out again
+    once its lease expires, and a file is merged into its answer file as soon
+    as its last function is done.
+
+    Tasks are handed out longest first by estimated cost across all queued
+    files, so a long function late in the input does not start last and
+    hold up the end of the run.
+    """
+
+    def __init__(self, db_path: str, lease_seconds: float = 600, max_attempts: int = 3):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # Autocommit mode; claims take the write lock explicitly with BEGIN IMMEDIATE
+        self.connection = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+        # Queue files from before tasks had a cost keep working, their tasks claimed in id order
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(tasks)")]
+        if columns and "cost" not in columns:
+            self.connection.execute("ALTER TABLE tasks ADD COLUMN cost INTEGER NOT NULL DEFAULT 0")
+        self.connection.executescript(SCHEMA)
+
+    def enqueue_directory(self, input_dir: str) -> int:
+        """Add one task per function of every input file, with its estimated cost; files already queued are left as they are"""
+        added = 0
+        for root, dirs, files in os.walk(input_dir):
+            for file in sorted(files):
+                file_path = os.path.join(root, file)
+                if self.connection.execute("SELECT 1 FROM files WHERE file = ?", (file_path,)).fetchone():
+                    continue
+                try:
+                    queries = read_queries(file_path)
+                except Exception:
+                    continue
+                self.connection.execute("BEGIN IMMEDIATE")
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO tasks (file, query_index, query, cost) VALUES (?, ?, ?, ?)",
+                    [(file_path, query_index, query, estimate_cost(query)) for query_index, query in enumerate(queries)],
+                )
+                self.connection.execute("INSERT OR IGNORE INTO files (file, total) VALUES (?, ?)", (file_path, len(queries)))
+                self.connection.execute("COMMIT")
+                added += len(queries)
+        return added
+
+    def claim(self, worker: str):
+        """Lease the costliest pending (or abandoned) task to a worker, returning (id, file, query_index, query) or None
+
+        An abandoned task that has used all its attempts, say one that crashes
+        every worker taking it, is marked failed instead of leased again.
+        """
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            self.connection.execute(
+                "UPDATE tasks SET status = 'failed', worker = NULL, lease_until = NULL "
+                "WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                (now, self.max_attempts),
+            )
+            task = self.connection.execute(
+                "SELECT id, file, query_index, query FROM tasks "
+                "WHERE status = 'pending' OR (status = 'running' AND lease_until < ?) "
+                "ORDER BY cost DESC, id LIMIT 1",
+                (now,),
+            ).fetchone()
+            if task is not None:
+                self.connection.execute(
+                    "UPDATE tasks SET status = 'running', worker = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                    (worker, now + self.lease_seconds, task[0]),
+                )
+            self.connection.execute("COMMIT")
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+        return task
+
+    def complete(self, task_id: int, result: str, records=None):
+        """Store a task's answer text and, when structured output is on, its line records"""
+        self.connection.execute(
+            "UPDATE tasks SET status = 'done', result = ?, records = ?, lease_until = NULL WHERE id = ?",
+            (result, json.dumps(records) if records is not None else None, task_id),
+        )
+
+    def release(self, task_id: int, failed: bool = False):
+        """Return a task to the queue, or mark it failed once it has used all its attempts"""
+        self.connection.execute(
+            "UPDATE tasks SET status = CASE WHEN ? AND attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "worker = NULL, lease_until = NULL WHERE id = ?",
+            (failed, self.max_attempts, task_id),
+        )
+
+    def merge_finished(self, output_dir: str) -> list:
+        """Write the answer file of every file whose tasks have all finished, in function order, failed ones marked"""
+        merged = []
+        finished = self.connection.execute(
+            "SELECT file FROM files WHERE merged = 0 AND NOT EXISTS "
+            "(SELECT 1 FROM tasks WHERE tasks.file = files.file AND status IN ('pending', 'running'))"
+        ).fetchall()
+        for (file_path,) in finished:
+            # Only one worker merges a file
+            claimed = self.connection.execute(
+                "UPDATE files SET merged = 1 WHERE file = ? AND merged = 0", (file_path,)
+            ).rowcount
+            if not claimed:
+                continue
+            rows = self.connection.execute(
+                "SELECT query_index, status, result, records FROM tasks WHERE file = ? ORDER BY query_index", (file_path,)
+            ).fetchall()
+            base_filename = os.path.basename(file_path).split('.')[0]
+            # A failed function keeps its place in the answer file, marked as failed
+            results = [
+                result if status == 'done' else f"Query {query_index + 1}:\n{FAILED_MARKER}\n"
+                for query_index, status, result, records in rows
+                if result or status == 'failed'
+            ]
+            write_output(os.path.join(output_dir, f"{base_filename}_RAG_answer.txt"), "\n/////\n".join(results))
+            if any(records is not None for query_index, status, result, records in rows):
+                with open(os.path.join(output_dir, f"{base_filename}_RAG_answer.jsonl"), "w", encoding="utf-8") as f:
+                    for query_index, status, result, records in rows:
+                        for record in json.loads(records or "[]"):
+                            f.write(json.dumps(record) + "\n")
+            merged.append(file_path)
+        return merged
+
+    def progress(self) -> dict:
+        """Task count and estimated cost in total and of the finished (done or failed) tasks"""
+        tasks, cost, finished, finished_cost = self.connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(cost), 0), "
+            "COALESCE(SUM(status IN ('done', 'failed')), 0), "
+            "COALESCE(SUM(CASE WHEN status IN ('done', 'failed') THEN cost ELSE 0 END), 0) FROM tasks"
+        ).fetchone()
+        return {"tasks": tasks, "cost": cost, "finished": finished, "finished_cost": finished_cost}
+
+    def counts(self) -> dict:
+        return dict(self.connection.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+
+    def close(self):
+        self.connection.close()
+
+
+class SharedUsage:
+    """Tokens used by all workers of a queue, kept in the queue file so one [BUDGET] covers them all
+
+    Has its own connection, as the ledger charges calls from any thread.
+    """
+
+    def __init__(self, db_path: str):
+        self.connection = sqlite3.connect(db_path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+
+    def add(self, tokens: int):
+        self.connection.execute("UPDATE usage SET tokens = tokens + ? WHERE id = 0", (tokens,))
+
+    def total(self) -> int:
+        return self.connection.execute("SELECT tokens FROM usage WHERE id = 0").fetchone()[0]